@@ -6,6 +6,8 @@
 """
 
 import json
+import mmap
+import os
 
 
 def save_column(file_r, file_w, sep='\t', col=1, headers=False):
@@ -30,6 +32,52 @@ def save_column(file_r, file_w, sep='\t', col=1, headers=False):
         file_w.write(line + '\n')  # записываем в файл
 
 
+def write_ndjson(objects, file_w):
+    """
+    Потоковый вывод в формате NDJSON: по одному json-объекту на строку, без
+    сортировки и построения всего списка в памяти.
+    :param objects: итерируемый набор объектов
+    :param file_w: файл для записи
+    """
+    for obj in objects:
+        file_w.write(json.dumps(obj, ensure_ascii=False) + '\n')
+
+
+def read_columns(file_name, columns, sep='\t', headers=False, offset=0):
+    """
+    Генератор значений выбранных столбцов файла с данными. Файл читается
+    один раз через mmap, без промежуточных файлов (в отличие от save_column).
+
+    :param file_name: имя файла с данными (utf-8)
+    :param columns: номера столбцов (нумерация с 1); вместо номера можно
+    указать None - тогда значением будет None
+    :param sep: разделитель столбцов (по умолчанию '\t')
+    :param headers: есть ли в файле заголовки (по умолчанию False);
+    заголовок пропускается, только если чтение идёт с начала файла
+    :param offset: позиция в байтах, с которой начинать чтение (начало
+    строки)
+    :return: генератор кортежей (значения столбцов списком, позиция в байтах
+    после прочитанной строки)
+    """
+    with open(file_name, 'rb') as file_r:
+        size = os.fstat(file_r.fileno()).st_size
+        if size <= offset:
+            return
+        with mmap.mmap(file_r.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            position = offset
+            if headers and not offset:
+                position = data.find(b'\n') + 1 or size
+            while position < size:
+                end = data.find(b'\n', position)
+                if end < 0:
+                    end = size
+                line = data[position:end].decode('utf-8').rstrip('\r\n')
+                line = line.split(sep)
+                position = end + 1
+                yield ([None if col is None else line[col - 1]
+                        for col in columns], min(position, size))
+
+
 def merge_files(file_r1, file_r2, file_w, sep='\t'):
     """
     Пост-обработка: объединяем леммы с исходным файлом. Функция принимает
@@ -51,3 +99,19 @@ def pretty_json(obj, file_w):
     :param file_w: файл для записи
     """
     json.dump(obj, file_w, sort_keys=True, indent=2, ensure_ascii=False)
+
+
+def pretty_json_items(items, file_w):
+    """
+    Pretty-вывод плоского словаря по частям, без построения словаря в памяти.
+    Формат совпадает с pretty_json, ключи выводятся в порядке поступления.
+    :param items: итерируемый набор пар (ключ, значение)
+    :param file_w: файл для записи
+    """
+    first = True
+    for key, value in items:
+        file_w.write('{\n  ' if first else ',\n  ')
+        file_w.write(json.dumps(key, ensure_ascii=False) + ': ' +
+                     json.dumps(value, ensure_ascii=False))
+        first = False
+    file_w.write('{}' if first else '\n}')
@@ -204,3 +204,32 @@ with open(file_edges_name, 'w') as file_edges, \
     pretty_json(edges, file_edges_json)
 
 print('Done Part2.3')
+
+### Часть 2.4.
+# Если нужны сразу несколько вариантов графа (с весами и по формулировкам,
+# с разными параметрами отбора лемм), то не обязательно вызывать функции
+# построения узлов и рёбер для каждого варианта: build_variants считает все
+# варианты за один проход по json-файлу. По умолчанию строятся все 8
+# сочетаний (см. lem.VARIANTS), а write_variants записывает узлы и рёбра
+# каждого варианта в отдельную подпапку.
+path_w_variants = path_w + 'Варианты/'
+with open(file_json_name, 'r') as file_json, \
+        open(file_weight_name, 'r') as file_weight:
+    variant_dicts = lem.build_variants(file_json, weights=file_weight)
+lem.write_variants(variant_dicts, path_w_variants)
+
+print('Done Part2.4')
+
+### Часть 2.5.
+# Графы по нескольким топам (как в части 2.3) можно построить за один проход:
+# build_dicts принимает список количеств строк checkpoints и после каждой
+# такой строки передаёт текущие узлы и рёбра функции on_checkpoint.
+# checkpoint_writer записывает их в подпапки top-N.
+tops = [100, 1000, 10000, 100000]
+with open(file_json_name, 'r') as file_json, \
+        open(file_weight_name, 'r') as file_weight:
+    lem.build_dicts(file_json, weights=file_weight, include_bastard=bastard,
+                    include_non_cyrillic=non_cyrillic, checkpoints=tops,
+                    on_checkpoint=lem.checkpoint_writer(path_w + 'Топы/'))
+
+print('Done Part2.5')
@@ -5,15 +5,44 @@
 Библиотека функций для работы с леммером Mystem: https://tech.yandex.ru/mystem/
 """
 
+import io
 import json
 import os
+import pickle
+import shutil
 import subprocess
+import tempfile
+import threading
+import time
+import zlib
+from array import array
 from collections import Counter
+from collections import deque
+from collections import namedtuple
+from contextlib import ExitStack
+from functools import lru_cache
 from itertools import combinations
-from itertools import repeat
+from itertools import islice
+from multiprocessing import Pool
+from queue import Queue
 
 from common_functions import merge_files
+from common_functions import read_columns
+from common_functions import write_ndjson
 from common_functions import pretty_json
+from common_functions import pretty_json_items
+from lem_cache import LemCache
+from lem_cache import normalize
+from lem_filters import WordFilter
+from lem_grammar import gr_mask
+from lem_grammar import gr_masks
+from lem_graph import CompactGraph
+from lem_heavy import HeavyEdgeCounter
+from lem_profile import NullRecorder
+from lem_snapshot import write_snapshot
+from lem_sparse import IncidenceBuilder
+from lem_spill import SpillCounter
+from lem_spill import sort_by_weight
 
 
 def lem(file_r, file_w, mystem='/Applications/mystem', params=None):
@@ -33,7 +62,395 @@ def lem(file_r, file_w, mystem='/Applications/mystem', params=None):
     subprocess.call([mystem] + params, stdin=file_r, stdout=file_w)
 
 
-def json_parse(line):
+def lem_output(file_r, mystem='/Applications/mystem', params=None):
+    """
+    Генератор: как функция lem, запускает один процесс Mystem на весь файл,
+    но возвращает вывод построчно по мере готовности (например, чтобы
+    следить за ходом работы). Вывод не изменяется и не сопоставляется со
+    строками ввода, поэтому подходят любые параметры запуска.
+
+    :param file_r: файл для чтения
+    :param mystem: путь до программы Mystem
+    :param params: параметры запуска списком (по умолчанию ['-clde', 'utf-8'])
+    :return: генератор строк вывода Mystem
+    """
+    if not params:
+        params = ['-clde', 'utf-8']
+    proc = subprocess.Popen([mystem] + params, stdin=file_r,
+                            stdout=subprocess.PIPE)
+    try:
+        # newline='' - переводы строк передаются как есть
+        yield from io.TextIOWrapper(proc.stdout, encoding='utf-8',
+                                    newline='')
+    except BaseException:
+        proc.kill()
+        raise
+    finally:
+        proc.stdout.close()
+        proc.wait()
+
+
+class MystemPool:
+    """
+    Пул долгоживущих процессов Mystem. Строки подаются процессам пачками
+    через pipe, результаты возвращаются в исходном порядке по мере готовности,
+    поэтому дальнейшая обработка может идти параллельно с лемматизацией.
+
+    Mystem должен выдавать ровно одну строку вывода на каждую входную строку
+    (например, с параметрами ['-cldige', 'utf-8', '--format', 'json']).
+
+    Пример:
+        with MystemPool(workers=4) as pool:
+            node_dict, edge_dict = build_dicts(pool.lem_lines(queries))
+    """
+
+    def __init__(self, mystem='/Applications/mystem', params=None,
+                 workers=None, batch_size=1000, max_pending=2):
+        """
+        :param mystem: путь до программы Mystem
+        :param params: параметры запуска списком (по умолчанию
+        ['-cldige', 'utf-8', '--format', 'json'])
+        :param workers: количество процессов Mystem (по умолчанию равно
+        количеству ядер)
+        :param batch_size: количество строк в одной пачке
+        :param max_pending: сколько пачек может одновременно находиться
+        в обработке у одного процесса (ограничивает расход памяти)
+        """
+        if not params:
+            params = ['-cldige', 'utf-8', '--format', 'json']
+        if not workers:
+            workers = os.cpu_count() or 1
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self.procs = []
+        self.stdouts = []
+        self.queues = []
+        self.threads = []
+
+        for _ in range(workers):
+            proc = subprocess.Popen([mystem] + params,
+                                    stdin=subprocess.PIPE,
+                                    stdout=subprocess.PIPE)
+            queue = Queue()
+            thread = threading.Thread(target=self._writer,
+                                      args=(proc.stdin, queue), daemon=True)
+            thread.start()
+            self.procs.append(proc)
+            self.stdouts.append(io.TextIOWrapper(proc.stdout,
+                                                 encoding='utf-8'))
+            self.queues.append(queue)
+            self.threads.append(thread)
+
+    @staticmethod
+    def _writer(stdin, queue):
+        """
+        Поток записи: отдаёт пачки строк процессу Mystem. Отдельный поток
+        нужен, чтобы процесс не заблокировался на переполненном pipe, пока
+        читаются результаты другого процесса.
+        """
+        try:
+            while True:
+                batch = queue.get()
+                if batch is None:
+                    break
+                stdin.write(''.join(batch).encode('utf-8'))
+                stdin.flush()
+        except (BrokenPipeError, ValueError):
+            pass
+        finally:
+            try:
+                stdin.close()
+            except BrokenPipeError:
+                pass
+
+    def _read(self, worker, count):
+        """
+        Читает count строк вывода процесса номер worker.
+        """
+        stdout = self.stdouts[worker]
+        for _ in range(count):
+            line = stdout.readline()
+            if not line:
+                raise RuntimeError('Mystem (процесс %d) неожиданно завершился'
+                                   % worker)
+            yield line
+
+    def lem_lines(self, lines):
+        """
+        Генератор: лемматизирует строки и возвращает вывод Mystem построчно
+        в исходном порядке. Результат можно сразу передавать в build_dicts,
+        build_node_dict и build_edge_dict вместо json-файла.
+        Одновременно может выполняться только один вызов lem_lines на пул.
+
+        :param lines: итерируемый набор строк (например, открытый файл)
+        :return: генератор строк вывода Mystem
+        """
+        workers = len(self.procs)
+        pending = deque()  # (процесс, количество строк) в порядке подачи
+        lines = (line.rstrip('\n') + '\n' for line in lines)
+        batch_number = 0
+
+        while True:
+            batch = list(islice(lines, self.batch_size))
+            if not batch:
+                break
+            # обратное давление: не подаём новую пачку, пока в обработке
+            # слишком много строк
+            while len(pending) >= workers * self.max_pending:
+                yield from self._read(*pending.popleft())
+
+            worker = batch_number % workers
+            self.queues[worker].put(batch)
+            pending.append((worker, len(batch)))
+            batch_number += 1
+
+        while pending:
+            yield from self._read(*pending.popleft())
+
+    def close(self):
+        """
+        Завершает процессы Mystem.
+        """
+        for queue in self.queues:
+            queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        for proc, stdout in zip(self.procs, self.stdouts):
+            stdout.close()
+            proc.wait()
+
+    def terminate(self):
+        """
+        Принудительно завершает процессы Mystem (например, при ошибке).
+        """
+        for proc in self.procs:
+            proc.kill()
+        self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.terminate()
+
+
+def lem_stream(lines, mystem='/Applications/mystem', params=None,
+               workers=None, batch_size=1000, parse=False):
+    """
+    Потоковая версия функции lem: лемматизирует строки пулом процессов
+    Mystem (см. MystemPool) и возвращает результаты в исходном порядке,
+    не дожидаясь обработки всего входа и не требуя промежуточных файлов.
+
+    :param lines: итерируемый набор строк
+    :param mystem: путь до программы Mystem
+    :param params: параметры запуска списком (по умолчанию
+    ['-cldige', 'utf-8', '--format', 'json'])
+    :param workers: количество процессов Mystem (по умолчанию равно
+    количеству ядер)
+    :param batch_size: количество строк в одной пачке
+    :param parse: возвращать результат функции json_parse вместо строк
+    вывода Mystem
+    :return: генератор строк вывода Mystem (или разобранных строк)
+    """
+    with MystemPool(mystem, params, workers, batch_size) as pool:
+        for line in pool.lem_lines(lines):
+            if parse:
+                yield json_parse(line)
+            else:
+                yield line
+
+
+def lem_cached(lines, cache, mystem='/Applications/mystem', workers=None,
+               batch_size=1000):
+    """
+    Лемматизация с кэшем: запросы, которые уже есть в кэше, берутся из него,
+    и только промахи отправляются в Mystem (см. MystemPool). Новые результаты
+    сохраняются в кэш. Строки возвращаются в исходном порядке.
+
+    Запросы нормализуются (см. lem_cache.normalize), поэтому в выводе могут
+    отличаться пробельные символы, но не леммы.
+
+    :param lines: итерируемый набор строк
+    :param cache: объект lem_cache.LemCache (параметры Mystem берутся из него)
+    :param mystem: путь до программы Mystem
+    :param workers: количество процессов Mystem (см. MystemPool)
+    :param batch_size: количество строк, проверяемых в кэше за один раз
+    :return: генератор строк вывода Mystem
+    """
+    pool = None  # процессы Mystem запускаются только при первом промахе
+    lines = (line.rstrip('\n') for line in lines)
+    try:
+        while True:
+            batch = list(islice(lines, batch_size))
+            if not batch:
+                break
+            found = cache.get_many(batch)
+
+            # отправляем в Mystem только уникальные промахи
+            misses = {}
+            for line in batch:
+                key = cache.key(line)
+                if key not in found and key not in misses:
+                    misses[key] = normalize(line)
+            if misses:
+                if pool is None:
+                    pool = MystemPool(mystem, cache.params, workers,
+                                      batch_size)
+                texts = list(misses.values())
+                results = list(pool.lem_lines(texts))
+                cache.put_many(zip(texts, results))
+                found.update(zip(misses, results))
+
+            for line in batch:
+                yield found[cache.key(line)]
+    except BaseException:
+        if pool is not None:
+            pool.terminate()
+            pool = None
+        raise
+    finally:
+        if pool is not None:
+            pool.close()
+
+
+def lem_rows(rows, mystem='/Applications/mystem', params=None, cache=None,
+             workers=None, batch_size=1000, file_query=None, file_weight=None,
+             file_json=None):
+    """
+    Лемматизирует запросы из пар (запрос, вес) без промежуточных файлов:
+    запросы подаются в Mystem по мере чтения, а веса держатся в памяти
+    в очереди, выровненной по строкам, пока не придёт вывод Mystem для их
+    строки. Результат можно сразу передавать в build_dicts:
+        json_lines, weights = lem_rows(rows)
+        node_dict, edge_dict = build_dicts(json_lines, weights)
+
+    :param rows: итерируемый набор пар (запрос, вес)
+    :param mystem: путь до программы Mystem
+    :param params: параметры запуска списком (см. MystemPool)
+    :param cache: объект lem_cache.LemCache (см. lem_cached)
+    :param workers: количество процессов Mystem (см. MystemPool)
+    :param batch_size: количество строк в одной пачке
+    :param file_query: файл для записи запросов (необязательный, для отладки)
+    :param file_weight: файл для записи весов (необязательный, для отладки)
+    :param file_json: файл для записи вывода Mystem (необязательный, для
+    отладки)
+    :return: кортеж (генератор строк вывода Mystem, генератор весов);
+    генератор весов нужно читать после соответствующей строки вывода
+    (как это делает zip)
+    """
+    weights = deque()
+
+    def queries():
+        for (query, weight) in rows:
+            weights.append(weight)
+            if file_query is not None:
+                print(query, file=file_query)
+            if file_weight is not None:
+                print(weight, file=file_weight)
+            yield query
+
+    if cache is not None:
+        json_lines = lem_cached(queries(), cache, mystem, workers, batch_size)
+    else:
+        json_lines = lem_stream(queries(), mystem, params, workers,
+                                batch_size)
+    if file_json is not None:
+        json_lines = tee_lines(json_lines, file_json)
+
+    def row_weights():
+        while weights:
+            yield weights.popleft()
+
+    return json_lines, row_weights()
+
+
+# Перевод заглавных кириллических букв в строчные (см. dedup_key)
+CYRILLIC_LOWER = str.maketrans('АБВГДЕЁЖЗИЙКЛМНОПРСТУФХЦЧШЩЪЫЬЭЮЯ',
+                               'абвгдеёжзийклмнопрстуфхцчшщъыьэюя')
+
+
+def dedup_key(query):
+    """
+    Ключ для поиска дублей запросов: схлопывает пробельные символы (см.
+    lem_cache.normalize) и приводит кириллические буквы к нижнему регистру
+    (леммы Mystem всё равно в нижнем регистре). Регистр латинских букв и
+    "ё" не меняются: для не кириллических слов лемма берётся из исходного
+    текста, а "ё" различает омографы (все/всё).
+
+    :param query: строка запроса
+    :return: ключ
+    """
+    return normalize(query).translate(CYRILLIC_LOWER)
+
+
+def dedup_rows(rows):
+    """
+    Схлопывает дубли запросов (см. dedup_key) с суммированием весов, чтобы
+    лемматизировать и считать каждый уникальный запрос один раз. Ключ
+    используется только для группировки: в Mystem уходит первый исходный
+    запрос группы.
+
+    :param rows: итерируемый набор пар (запрос, вес)
+    :return: кортеж (список пар (первый запрос группы, суммарный вес) в
+    порядке первого появления, массив номеров уникального запроса для
+    каждой исходной строки)
+    """
+    ids = {}
+    unique = []
+    row_ids = array('q')
+    for (query, weight) in rows:
+        key = dedup_key(query)
+        unique_id = ids.get(key)
+        if unique_id is None:
+            unique_id = ids[key] = len(unique)
+            unique.append([query, 0])
+        unique[unique_id][1] += int(weight)
+        row_ids.append(unique_id)
+    return [tuple(item) for item in unique], row_ids
+
+
+def expand_lines(lines, row_ids, file_w):
+    """
+    Записывает строки уникальных запросов обратно для каждой исходной строки
+    (обратно dedup_rows).
+
+    :param lines: строки уникальных запросов (с переводом строки)
+    :param row_ids: номера уникальных запросов исходных строк (см.
+    dedup_rows)
+    :param file_w: файл для записи
+    """
+    for unique_id in row_ids:
+        file_w.write(lines[unique_id])
+
+
+def tee_lines(lines, file_w):
+    """
+    Генератор, который возвращает строки и одновременно записывает их в файл.
+    """
+    for line in lines:
+        file_w.write(line)
+        yield line
+
+
+def write_lem_lines(lines, file_w, stage=None):
+    """
+    Записывает строки вывода Mystem в файл и учитывает каждую строку
+    в замере этапа.
+
+    :param lines: итерируемый набор строк вывода Mystem
+    :param file_w: файл для записи
+    :param stage: замер этапа (см. lem_profile.Stage) или None
+    """
+    for line in lines:
+        file_w.write(line)
+        if stage is not None:
+            stage.add()
+
+
+def json_parse(line, masks=False):
     """
     Функция читает строку с json-выводом Mystem и приводит её
     в более удобный вид. Возвращает список распознанных лемм вида:
@@ -51,58 +468,185 @@ def json_parse(line):
     }
 
     :param line: json-строка
+    :param masks: добавлять в gr_parse битовые маски граммем (см. gr_parse)
     :return: line_parse
     """
     line_parse = []  # распарсенный список слов
-    words = json.loads(line)  # json-строка, разбитая на части
 
-    for i in range(len(words)):
-        word = words[i]
-        text = word['text']
-        line_parse.append({'text': text})
-        if 'analysis' not in word:
+    for word in json.loads(line):
+        parsed = {'text': word['text']}
+        line_parse.append(parsed)
+        analysis = word.get('analysis')
+        if analysis is None:
             continue
 
-        analysis = word['analysis']
-        line_parse[i]['analysis'] = True
-        analysis_len = len(analysis)
-        line_parse[i]['analysis_len'] = analysis_len
+        parsed['analysis'] = True
+        parsed['analysis_len'] = len(analysis)
 
-        if analysis_len == 0:  # если отсутствует анализ слова
+        if not analysis:  # если отсутствует анализ слова
             continue
 
         analyse = analysis[0]
-        lex = analyse['lex']
-        line_parse[i]['lex'] = lex
-
+        parsed['lex'] = analyse['lex']
         if 'qual' in analyse:
-            line_parse[i]['qual'] = analyse['qual']
-
-        gr = analyse['gr']
-        line_parse[i]['gr'] = gr
-        line_parse[i]['gr_parse'] = gr_parse(gr)
+            parsed['qual'] = analyse['qual']
+        parsed['gr'] = analyse['gr']
+        parsed['gr_parse'] = gr_parse(analyse['gr'], masks)
 
     return line_parse
 
 
-def gr_parse(gr):
+def gr_parse(gr, masks=False):
     """
     Парсит строчку с грамматикой. Подробно о грамматике можно почитать здесь:
     https://tech.yandex.ru/mystem/doc/grammemes-values-docpage/
-    Пока возвращает только первую половину до знака "равно" и часть речи.
+    Возвращает первую половину до знака "равно" и часть речи, а с
+    masks=True - ещё и битовые маски всех граммем (см. lem_grammar): 'mask' -
+    объединение вариантов разбора, 'masks' - маски каждого варианта (a|b|c).
 
     :param gr: строка с грамматикой
+    :param masks: добавлять битовые маски граммем
     """
-    parsed = {}
-    (first_part, second_part) = gr.split('=', 1)
-    parsed['first_part'] = first_part
-    parsed['part_speech'] = first_part.split(',')[0]
+    (first_part, part_speech) = gr_split(gr)
+    parsed = {'first_part': first_part, 'part_speech': part_speech}
+    if masks:
+        parsed['mask'] = gr_mask(gr)
+        parsed['masks'] = list(gr_masks(gr))
 
     return parsed
 
 
-def lem_filter(line_parse, include_bastard=True, include_non_cyrillic=True):
-    # TODO: сделать так, чтобы можно было безболезненно расширять параметры
+@lru_cache(maxsize=65536)
+def gr_split(gr):
+    """
+    Кэшируемая часть gr_parse: различных строк грамматики немного, а
+    встречаются они миллионы раз.
+
+    :param gr: строка с грамматикой
+    :return: кортеж (первая половина до знака "равно", часть речи)
+    """
+    first_part = gr.split('=', 1)[0]
+    return first_part, first_part.split(',', 1)[0]
+
+
+@lru_cache(maxsize=65536)
+def gr_fields(gr):
+    """
+    Кэшируемые поля Word для строки грамматики.
+
+    :param gr: строка с грамматикой
+    :return: кортеж (часть речи, маска граммем, см. lem_grammar.gr_mask)
+    """
+    return gr_split(gr)[1], gr_mask(gr)
+
+
+# Слово из json-вывода Mystem (см. parse_tokens). analysis_len равно None,
+# если секция анализа отсутствует; lex, qual и gr равны None, а mask (маска
+# граммем, см. lem_grammar.gr_mask) равна 0, если анализ пустой или
+# отсутствует
+Token = namedtuple('Token', ['text', 'analysis_len', 'lex', 'qual', 'gr',
+                             'mask'])
+
+# Отобранная лемма (см. filter_words), поля как у объектов lem_filter
+Word = namedtuple('Word', ['lex', 'part_speech', 'bastard', 'non_cyrillic',
+                           'mask'])
+
+
+def parse_tokens(line):
+    """
+    Быстрый вариант json_parse: вместо словарей возвращает список
+    компактных записей Token и берёт из вывода Mystem только text, lex,
+    qual и gr. Маска граммем считается один раз для каждой строки gr.
+
+    :param line: json-строка
+    :return: список Token
+    """
+    tokens = []
+    for word in json.loads(line):
+        analysis = word.get('analysis')
+        if analysis is None:
+            tokens.append(Token(word['text'], None, None, None, None, 0))
+        elif not analysis:
+            tokens.append(Token(word['text'], 0, None, None, None, 0))
+        else:
+            analyse = analysis[0]
+            tokens.append(Token(word['text'], len(analysis), analyse['lex'],
+                                analyse.get('qual'), analyse['gr'],
+                                gr_mask(analyse['gr'])))
+    return tokens
+
+
+def filter_words(tokens, include_bastard=True, include_non_cyrillic=True,
+                 word_filter=None):
+    """
+    Быстрый вариант lem_filter для вывода parse_tokens.
+
+    :param tokens: output функции parse_tokens
+    :param include_bastard: см. lem_filter
+    :param include_non_cyrillic: см. lem_filter
+    :param word_filter: см. lem_filter
+    :return: список Word
+    """
+    words = []
+    for token in tokens:
+        if token.analysis_len is None:
+            continue
+        if token.analysis_len == 0:
+            if include_non_cyrillic and (
+                    word_filter is None or word_filter(token.text, None,
+                                                       False)):
+                words.append(Word(token.text, None, False, True, 0))
+            continue
+        bastard = token.qual is not None
+        if bastard and not include_bastard:
+            continue
+        part_speech = gr_split(token.gr)[1]
+        if word_filter is not None and \
+                not word_filter(token.lex, part_speech, bastard, token.gr):
+            continue
+        words.append(Word(token.lex, part_speech, bastard, False, token.mask))
+    return words
+
+
+def line_words(line, include_bastard=True, include_non_cyrillic=True,
+               word_filter=None):
+    """
+    Разбирает строку json-вывода Mystem и отбирает леммы. Результат тот же,
+    что у filter_words(parse_tokens(line)), но промежуточные записи Token не
+    создаются. Используется функциями построения узлов и рёбер.
+
+    :param line: json-строка
+    :param include_bastard: см. lem_filter
+    :param include_non_cyrillic: см. lem_filter
+    :param word_filter: см. lem_filter
+    :return: список Word
+    """
+    words = []
+    for word in json.loads(line):
+        analysis = word.get('analysis')
+        if analysis is None:
+            continue
+        if not analysis:
+            if include_non_cyrillic and (
+                    word_filter is None or word_filter(word['text'], None,
+                                                       False)):
+                words.append(Word(word['text'], None, False, True, 0))
+            continue
+        analyse = analysis[0]
+        bastard = 'qual' in analyse
+        if bastard and not include_bastard:
+            continue
+        gr = analyse['gr']
+        (part_speech, mask) = gr_fields(gr)
+        if word_filter is not None and \
+                not word_filter(analyse['lex'], part_speech, bastard, gr):
+            continue
+        words.append(Word(analyse['lex'], part_speech, bastard, False, mask))
+    return words
+
+
+def lem_filter(line_parse, include_bastard=True, include_non_cyrillic=True,
+               word_filter=None, masks=False):
     """
     Функция отбирает леммы из распарсенной строки.
     При необходимости преобразует леммы.
@@ -112,6 +656,8 @@ def lem_filter(line_parse, include_bastard=True, include_non_cyrillic=True):
     'part_speech': str - часть речи
     'bastard': True/False
     'non_cyrillic': True/False
+    'mask': int - маска граммем (см. lem_grammar.gr_mask), 0 для слов без
+    анализа. Только если masks=True
     }
 
     :param line_parse: output функции json_parse
@@ -120,6 +666,10 @@ def lem_filter(line_parse, include_bastard=True, include_non_cyrillic=True):
     :param include_non_cyrillic: нужно ли включать слова, для которых Mystem
     вернул секцию "анализ" нулевой длины? Обычно такое происходит для слов с
     не кириллическими символами
+    :param word_filter: дополнительные правила отбора (части речи,
+    граммемы, стоп-леммы, регулярные выражения, минимальная длина), см.
+    lem_filters.WordFilter
+    :param masks: добавлять ли маски граммем (ключ 'mask')
     :return: line_filter
     """
     line_filter = []
@@ -134,6 +684,7 @@ def lem_filter(line_parse, include_bastard=True, include_non_cyrillic=True):
             lex = word['text']
             part_speech = None
             bastard = False
+            gr = None
         else:
             if 'qual' in word:
                 if not include_bastard:
@@ -145,13 +696,20 @@ def lem_filter(line_parse, include_bastard=True, include_non_cyrillic=True):
             non_cyrillic = False
             lex = word['lex']
             part_speech = word['gr_parse']['part_speech']
+            gr = word['gr']
 
-        line_filter.append({
+        if word_filter is not None and \
+                not word_filter(lex, part_speech, bastard, gr):
+            continue
+        lem_info = {
             'lex': lex,
             'part_speech': part_speech,
             'bastard': bastard,
             'non_cyrillic': non_cyrillic,
-        })
+        }
+        if masks:
+            lem_info['mask'] = 0 if gr is None else gr_mask(gr)
+        line_filter.append(lem_info)
 
     return line_filter
 
@@ -161,8 +719,160 @@ def line_with_part_speeches():
     pass
 
 
+def add_edges(edge_dict, lems, weight):
+    """
+    Добавляет в счётчик рёбер все возможные пары лемм одной строки.
+
+    :param edge_dict: счётчик рёбер (Counter, HeavyEdgeCounter или
+    SpillCounter)
+    :param lems: множество уникальных лемм строки
+    :param weight: вес строки (int)
+    """
+    # составляем список всех возможных пар лемм без повторов
+    add_pairs(edge_dict, combinations(sorted(lems), 2), weight)
+
+
+def window_pairs(lexes, window, max_pairs=None):
+    """
+    Пары лемм, которые встречаются в строке на расстоянии меньше window
+    слов друг от друга. Пары перебираются по возрастанию расстояния: сначала
+    соседние слова, затем слова через одно и т. д. (при равном расстоянии -
+    в порядке следования в строке). Каждая пара учитывается один раз, пары
+    одинаковых лемм отбрасываются. Работа - O(n * window) вместо O(n^2) для
+    всех пар.
+
+    :param lexes: список лемм строки в исходном порядке
+    :param window: размер окна (2 - только соседние слова)
+    :param max_pairs: если указан, то не больше max_pairs ближайших пар
+    :return: список отсортированных пар лемм
+    """
+    pairs_set = set()
+    pairs_list = []
+    length = len(lexes)
+    for distance in range(1, min(window, length)):
+        for i in range(length - distance):
+            lex_a = lexes[i]
+            lex_b = lexes[i + distance]
+            if lex_a == lex_b:
+                continue
+            pair = (lex_a, lex_b) if lex_a < lex_b else (lex_b, lex_a)
+            if pair in pairs_set:
+                continue
+            pairs_set.add(pair)
+            pairs_list.append(pair)
+            if max_pairs and len(pairs_list) >= max_pairs:
+                return pairs_list
+    return pairs_list
+
+
+def line_pairs(words, window=None, max_pairs=None):
+    """
+    Пары лемм одной строки для подсчёта рёбер.
+
+    :param words: output функции line_words
+    :param window: если указан, то только пары в окне window слов
+    (см. window_pairs); иначе все пары уникальных лемм
+    :param max_pairs: если указан, то не больше max_pairs пар на строку:
+    берутся пары слов, ближайших друг к другу в строке (см. window_pairs),
+    а не первые по алфавиту
+    :return: итерируемый набор отсортированных пар лемм
+    """
+    if window or max_pairs:
+        lexes = [word.lex for word in words]
+        return window_pairs(lexes, window or len(lexes), max_pairs)
+    return combinations(sorted({word.lex for word in words}), 2)
+
+
+def add_pairs(edge_dict, pairs_list, weight):
+    """
+    Добавляет в счётчик рёбер пары лемм одной строки.
+
+    :param edge_dict: счётчик рёбер (Counter, HeavyEdgeCounter или
+    SpillCounter)
+    :param pairs_list: итерируемый набор отсортированных пар лемм без
+    повторов
+    :param weight: вес строки (int)
+    """
+    # счётчики с ограниченной памятью сами решают, как хранить пары
+    if isinstance(edge_dict, (HeavyEdgeCounter, SpillCounter)):
+        edge_dict.add_pairs(pairs_list, weight)
+        return
+
+    # добавляем каждую пару в словарь
+    for pair in pairs_list:
+        edge_dict[pair] += weight
+
+
+def add_nodes(node_dict, words, weight):
+    """
+    Добавляет в словарь узлов уникальные леммы одной строки.
+
+    :param node_dict: словарь узлов
+    :param words: output функции line_words
+    :param weight: вес строки (int)
+    :return: множество уникальных лемм строки
+    """
+    # TODO: Продумать, что делать, если в одной строке встречаются
+    # одинаковые леммы, относящиеся к разным частям речи
+    lexs_unique = set()  # множество уже добавленных лемм
+    for word in words:
+        lex = word.lex
+        if lex in lexs_unique:
+            continue
+        part_speech = word.part_speech
+        if lex not in node_dict:
+            node_dict[lex] = {
+                'lex': lex,
+                'part_speech': Counter(),
+                'bastard': word.bastard,
+                'non_cyrillic': word.non_cyrillic,
+                'count': 0,
+            }
+
+        node_dict[lex]['count'] += weight
+        node_dict[lex]['part_speech'][part_speech] += weight
+        lexs_unique.add(lex)
+
+    return lexs_unique
+
+
+def weighted_lines(file_json, weights=None):
+    """
+    Генератор пар (строка, вес).
+
+    :param file_json: строки json-вывода Mystem
+    :param weights: веса строк (например, файл с весами запросов). Если
+    None, то каждой строке присваивается единичный вес. Пустые строки после
+    последнего веса (например, лишний перевод строки в конце файла)
+    пропускаются
+    :raise ValueError: если количество весов не совпадает с количеством строк
+    """
+    if weights is None:
+        for line in file_json:
+            yield line, 1
+        return
+    weights = iter(weights)
+    for line in file_json:
+        weight = next(weights, None)
+        if weight is None:
+            raise ValueError('Весов меньше, чем строк')
+        yield line, weight
+    for weight in weights:
+        if not is_blank(weight):
+            raise ValueError('Весов больше, чем строк')
+
+
+def is_blank(weight):
+    """
+    Пустой ли вес (пустая строка или строка из пробельных символов).
+    """
+    return isinstance(weight, str) and not weight.strip()
+
+
 def build_edge_dict(file_json, weights=None,
-                    include_bastard=True, include_non_cyrillic=True):
+                    include_bastard=True, include_non_cyrillic=True,
+                    workers=None, budget=None, max_items=None, window=None,
+                    max_pairs=None, word_filter=None):
     """
     Функция создаёт счётчик (словарь) рёбер.
 
@@ -172,35 +882,64 @@ def build_edge_dict(file_json, weights=None,
     запросу присваивается единичный вес
     :param include_bastard: смотри lem_filter
     :param include_non_cyrillic: смотри lem_filter
-    :return: Counter вида: {ребро: количество}
+    :param workers: количество процессов (см. build_parallel). По умолчанию
+    подсчёт идёт в текущем процессе
+    :param budget: если указан, то рёбра считаются приближённо в
+    ограниченной памяти: хранится не больше 2 * budget рёбер
+    (см. lem_heavy.HeavyEdgeCounter). Несовместим с workers
+    :param max_items: если указан, то в памяти держится не больше max_items
+    рёбер, остальные сбрасываются на диск (см. lem_spill.SpillCounter).
+    Несовместим с workers
+    :param window: если указан, то рёбрами связываются только леммы,
+    стоящие в строке на расстоянии меньше window слов (для длинных текстов,
+    см. window_pairs). По умолчанию связываются все леммы строки
+    :param max_pairs: если указан, то из строки берётся не больше max_pairs
+    пар слов, ближайших друг к другу (см. line_pairs)
+    :param word_filter: дополнительные правила отбора лемм (см. lem_filter)
+    :return: Counter вида: {ребро: количество} (или HeavyEdgeCounter,
+    или SpillCounter)
+    :raise ValueError: если вместе с workers указан budget или max_items
     """
-    edge_dict = Counter()  # счётчик рёбер
-
-    if not weights:
-        weights = repeat(1)
-
-    for (line, weight) in zip(file_json, weights):
-        # парсим строку вывода Mystem
-        line_parse = json_parse(line)
-        # отбираем слова, удовлетворяющие нашим критериям
-        words = lem_filter(line_parse, include_bastard, include_non_cyrillic)
-        # оставляем только уникальные леммы (чтобы повторно не считать
-        # повторяющиеся в строке леммы)
-        lems = {word['lex'] for word in words}
-
-        # составляем список всех возможных пар лемм без повторов
-        pairs_list = combinations(sorted(lems), 2)
-
-        # добавляем каждую пару в словарь
-        for pair in pairs_list:
-            edge_dict[pair] += int(weight)
+    if (budget or max_items) and workers and workers > 1:
+        raise ValueError('budget и max_items несовместимы с workers')
+    if budget:
+        edge_dict = HeavyEdgeCounter(budget)
+    elif max_items:
+        edge_dict = SpillCounter(max_items)
+    elif workers and workers > 1 and file_name_of(file_json):
+        return build_parallel(file_json, weights, include_bastard,
+                              include_non_cyrillic, workers, 'edges',
+                              window=window, max_pairs=max_pairs,
+                              word_filter=word_filter)[1]
+    else:
+        edge_dict = Counter()  # счётчик рёбер
+
+    with ExitStack() as stack:
+        # при ошибке временные файлы SpillCounter удаляются
+        if isinstance(edge_dict, SpillCounter):
+            stack.enter_context(edge_dict)
+        for (line, weight) in weighted_lines(file_json, weights):
+            # парсим строку вывода Mystem и отбираем слова, удовлетворяющие
+            # нашим критериям
+            words = line_words(line, include_bastard, include_non_cyrillic,
+                               word_filter)
+            if window or max_pairs:
+                add_pairs(edge_dict, line_pairs(words, window, max_pairs),
+                          int(weight))
+                continue
+            # оставляем только уникальные леммы (чтобы повторно не считать
+            # повторяющиеся в строке леммы)
+            lems = {word.lex for word in words}
+            # добавляем все возможные пары лемм в словарь
+            add_edges(edge_dict, lems, int(weight))
+        stack.pop_all()
 
     return edge_dict
 
 
 def build_node_dict(file_json, weights=None,
-                    include_bastard=True, include_non_cyrillic=True):
-    # TODO: сделать так, чтобы можно было безболезненно расширять параметры
+                    include_bastard=True, include_non_cyrillic=True,
+                    workers=None, word_filter=None):
     """
     Функция создаёт словарь узлов.
 
@@ -210,6 +949,9 @@ def build_node_dict(file_json, weights=None,
     запросу присваивается единичный вес
     :param include_bastard: смотри lem_filter
     :param include_non_cyrillic: смотри lem_filter
+    :param workers: количество процессов (см. build_parallel). По умолчанию
+    подсчёт идёт в текущем процессе
+    :param word_filter: дополнительные правила отбора лемм (см. lem_filter)
     :return: словарь вида:
     {узел:
         'count': int
@@ -219,55 +961,600 @@ def build_node_dict(file_json, weights=None,
             {часть речиN: количествоN}
     }
     """
+    if workers and workers > 1 and file_name_of(file_json):
+        return build_parallel(file_json, weights, include_bastard,
+                              include_non_cyrillic, workers, 'nodes',
+                              word_filter=word_filter)[0]
+
     node_dict = {}  # счётчик узлов
 
-    if not weights:
-        weights = repeat(1)
+    for (line, weight) in weighted_lines(file_json, weights):
+        # парсим строку вывода Mystem и отбираем слова, удовлетворяющие
+        # нашим критериям
+        words = line_words(line, include_bastard, include_non_cyrillic,
+                           word_filter)
 
-    for (line, weight) in zip(file_json, weights):
-        # парсим строку вывода Mystem
-        line_parse = json_parse(line)
-        # отбираем слова, удовлетворяющие нашим критериям
-        words = lem_filter(line_parse, include_bastard, include_non_cyrillic)
+        # добавляем каждую уникальную лемму в словарь
+        add_nodes(node_dict, words, int(weight))
 
-        # TODO: Продумать, что делать, если в одной строке встречаются
-        # одинаковые леммы, относящиеся к разным частям речи
+    return node_dict
 
-        # добавляем каждую уникальную лемму в словарь
-        lexs_unique = []  # список уже добавленных лемм
-        for word in words:
-            lex = word['lex']
-            if lex in lexs_unique:
+
+def build_dicts(file_json, weights=None,
+                include_bastard=True, include_non_cyrillic=True,
+                file_lems=None, workers=None, budget=None, max_items=None,
+                window=None, max_pairs=None, sparse=False, sparse_cut=0,
+                stage=None, word_filter=None, checkpoints=None,
+                on_checkpoint=None):
+    """
+    Функция за один проход создаёт словарь узлов и счётчик рёбер. Каждая
+    строка json-вывода Mystem разбирается и фильтруется только один раз.
+    Результат совпадает с результатами build_node_dict и build_edge_dict.
+
+    :param file_json: файл в json-выводом Mystem (тестировалось с параметрами
+    ['-cldige', 'utf-8', '--format', 'json'])
+    :param weights: файл с весами запросов. Если отсутствует, то каждому
+    запросу присваивается единичный вес
+    :param include_bastard: смотри lem_filter
+    :param include_non_cyrillic: смотри lem_filter
+    :param file_lems: файл, в который записываются отобранные леммы каждой
+    строки через пробел (необязательный, для проверки)
+    :param workers: количество процессов (см. build_parallel). По умолчанию
+    подсчёт идёт в текущем процессе
+    :param budget: приближённый подсчёт рёбер (см. build_edge_dict).
+    Несовместим с workers
+    :param max_items: подсчёт рёбер с выгрузкой на диск (см.
+    build_edge_dict). Несовместим с workers
+    :param window: рёбра только в окне слов (см. build_edge_dict)
+    :param max_pairs: ограничение пар на строку (см. build_edge_dict)
+    :param sparse: считать рёбра через разреженные матрицы (см.
+    lem_sparse.IncidenceBuilder, нужны numpy и scipy). Несовместим с workers,
+    budget, max_items, window и max_pairs
+    :param sparse_cut: в режиме sparse не возвращать рёбра с весом меньше,
+    чем sparse_cut
+    :param stage: замер этапа (см. lem_profile.Recorder): строки, пары лемм
+    и время разбора json (часть 'parse'). В параллельном режиме не ведётся
+    :param word_filter: дополнительные правила отбора лемм (см. lem_filter)
+    :param checkpoints: список количеств строк (топ-N) для промежуточных
+    результатов: после N-й строки вызывается on_checkpoint. Так графы по
+    нескольким топам строятся за один проход. Если строк меньше N, то
+    результат для N - полный граф. Несовместим с workers
+    :param on_checkpoint: функция вида f(N, node_dict, edge_dict), которая
+    получает текущие словари (например, checkpoint_writer). Словари после
+    вызова продолжают изменяться, поэтому сохранять их нужно сразу
+    :return: кортеж (node_dict, edge_dict), см. build_node_dict и
+    build_edge_dict
+    """
+    if sparse and (workers and workers > 1 or budget or max_items or
+                   window or max_pairs):
+        raise ValueError('Режим sparse несовместим с workers, budget, '
+                         'max_items, window и max_pairs')
+    if (budget or max_items) and workers and workers > 1:
+        raise ValueError('budget и max_items несовместимы с workers')
+    checkpoints = sorted(set(checkpoints or ()))
+    if checkpoints and (workers and workers > 1 or on_checkpoint is None):
+        raise ValueError('checkpoints несовместим с workers и требует '
+                         'on_checkpoint')
+    if checkpoints and checkpoints[0] < 1:
+        raise ValueError('checkpoints должны быть положительными')
+    if sparse:
+        edge_dict = IncidenceBuilder()
+    elif budget:
+        edge_dict = HeavyEdgeCounter(budget)
+    elif max_items:
+        edge_dict = SpillCounter(max_items)
+    elif workers and workers > 1 and file_name_of(file_json):
+        return build_parallel(file_json, weights, include_bastard,
+                              include_non_cyrillic, workers, 'both',
+                              file_lems, window, max_pairs, word_filter)
+    else:
+        edge_dict = Counter()  # счётчик рёбер
+    node_dict = {}  # счётчик узлов
+
+    checkpoints = deque(checkpoints)
+    lines = weighted_lines(file_json, weights)
+    with ExitStack() as stack:
+        # при ошибке временные файлы SpillCounter удаляются
+        if isinstance(edge_dict, SpillCounter):
+            stack.enter_context(edge_dict)
+        for (row, (line, weight)) in enumerate(lines, 1):
+            # парсим строку вывода Mystem и отбираем слова, удовлетворяющие
+            # нашим критериям
+            if stage is not None:
+                started = time.perf_counter()
+            words = line_words(line, include_bastard, include_non_cyrillic,
+                               word_filter)
+            if stage is not None:
+                stage.part('parse', time.perf_counter() - started)
+            if file_lems is not None:
+                print(' '.join(word.lex for word in words), file=file_lems)
+
+            weight = int(weight)
+            lems = add_nodes(node_dict, words, weight)
+            pairs_count = None  # количество пар, если отличается от полного
+            if sparse:
+                edge_dict.add_line(lems, weight)
+            elif window or max_pairs:
+                pairs_list = list(line_pairs(words, window, max_pairs))
+                add_pairs(edge_dict, pairs_list, weight)
+                pairs_count = len(pairs_list)
+            else:
+                add_edges(edge_dict, lems, weight)
+            if stage is not None:
+                if pairs_count is None:
+                    pairs_count = len(lems) * (len(lems) - 1) // 2
+                stage.add(1, pairs_count)
+            if checkpoints and row == checkpoints[0]:
+                checkpoints.popleft()
+                on_checkpoint(row, node_dict,
+                              edge_dict.cooccurrence(sparse_cut)
+                              if sparse else edge_dict)
+        stack.pop_all()
+
+    if sparse:
+        edge_dict = edge_dict.cooccurrence(sparse_cut)
+    # топы больше количества строк совпадают с полным графом
+    for checkpoint in checkpoints:
+        on_checkpoint(checkpoint, node_dict, edge_dict)
+    return node_dict, edge_dict
+
+
+def build_graph(file_json, weights=None,
+                include_bastard=True, include_non_cyrillic=True,
+                file_lems=None, word_filter=None):
+    """
+    Функция за один проход создаёт компактный граф (см. lem_graph.CompactGraph)
+    вместо словарей узлов и рёбер. Граф можно сразу передавать в
+    write_node_dict и write_edge_dict.
+
+    :param file_json: файл в json-выводом Mystem
+    :param weights: файл с весами запросов. Если отсутствует, то каждому
+    запросу присваивается единичный вес
+    :param include_bastard: смотри lem_filter
+    :param include_non_cyrillic: смотри lem_filter
+    :param file_lems: см. build_dicts
+    :param word_filter: дополнительные правила отбора лемм (см. lem_filter)
+    :return: CompactGraph
+    """
+    graph = CompactGraph()
+
+    for (line, weight) in weighted_lines(file_json, weights):
+        words = line_words(line, include_bastard, include_non_cyrillic,
+                           word_filter)
+        if file_lems is not None:
+            print(' '.join(word.lex for word in words), file=file_lems)
+        graph.add_line(words, int(weight))
+
+    graph.pack()
+    return graph
+
+
+# Вариант графа для build_variants: имя (подпапка для write_variants),
+# учитывать ли веса запросов и параметры отбора лемм (см. lem_filter)
+Variant = namedtuple('Variant', ['name', 'weights', 'bastard',
+                                 'non_cyrillic'])
+
+# Все сочетания: с весами и по формулировкам x bastard x non_cyrillic
+VARIANTS = [Variant('%s_%s_%s' % ('weights' if weights else 'forms',
+                                  'bastard' if bastard else 'no_bastard',
+                                  'non_cyrillic' if non_cyrillic
+                                  else 'cyrillic'),
+                    weights, bastard, non_cyrillic)
+            for weights in (True, False) for bastard in (True, False)
+            for non_cyrillic in (True, False)]
+
+
+def build_variants(file_json, weights=None, variants=None, word_filter=None):
+    """
+    Функция за один проход создаёт словари узлов и рёбер для нескольких
+    вариантов графа (с весами и без, с разными параметрами отбора лемм).
+    Каждая строка разбирается один раз, а пары лемм составляются один раз
+    для всех вариантов с одинаковым отбором. Результат для каждого варианта
+    совпадает с build_node_dict и build_edge_dict с теми же параметрами.
+
+    :param file_json: файл в json-выводом Mystem
+    :param weights: файл с весами запросов (для вариантов с весами). Если
+    отсутствует, то каждому запросу присваивается единичный вес
+    :param variants: список Variant (по умолчанию VARIANTS - все 8 сочетаний)
+    :param word_filter: дополнительные правила отбора лемм для всех
+    вариантов (см. lem_filter)
+    :return: словарь вида {имя варианта: (node_dict, edge_dict)}
+    """
+    if variants is None:
+        variants = VARIANTS
+    dicts = {}
+    for variant in variants:
+        if variant.name in dicts:
+            raise ValueError('Duplicate variant name: %s' % variant.name)
+        dicts[variant.name] = ({}, Counter())
+
+    # варианты с одинаковым отбором лемм делят отобранные леммы и пары
+    groups = {}
+    for variant in variants:
+        groups.setdefault((variant.bastard, variant.non_cyrillic),
+                          []).append(variant)
+
+    for (line, weight) in weighted_lines(file_json, weights):
+        words = line_words(line, word_filter=word_filter)
+        weight = int(weight)
+        for ((bastard, non_cyrillic), group) in groups.items():
+            selected = [word for word in words
+                        if (bastard or not word.bastard) and
+                        (non_cyrillic or not word.non_cyrillic)]
+            pairs_list = None
+            for variant in group:
+                (node_dict, edge_dict) = dicts[variant.name]
+                variant_weight = weight if variant.weights else 1
+                lems = add_nodes(node_dict, selected, variant_weight)
+                if pairs_list is None:
+                    pairs_list = list(combinations(sorted(lems), 2))
+                add_pairs(edge_dict, pairs_list, variant_weight)
+
+    return dicts
+
+
+def write_variants(dicts, path_w, nodes_cut=0, edges_cut=0):
+    """
+    Записывает узлы и рёбра каждого варианта (см. build_variants) для Gephi
+    в подпапку с именем варианта: <path_w>/<имя>/nodes.csv и edges.csv.
+
+    :param dicts: output функции build_variants
+    :param path_w: путь к папке для записи
+    :param nodes_cut: см. функцию write_node_dict
+    :param edges_cut: см. функцию write_edge_dict
+    """
+    for (name, (node_dict, edge_dict)) in dicts.items():
+        path_variant = os.path.join(path_w, name)
+        if not os.path.exists(path_variant):
+            os.makedirs(path_variant)
+        with open(os.path.join(path_variant, 'nodes.csv'), 'w') as file_nodes:
+            write_node_dict(file_nodes, node_dict, sep=';', cut=nodes_cut)
+        with open(os.path.join(path_variant, 'edges.csv'), 'w') as file_edges:
+            write_edge_dict(file_edges, edge_dict, sep=';', cut=edges_cut)
+
+
+def checkpoint_writer(path_w, nodes_cut=0, edges_cut=0):
+    """
+    Функция для параметра on_checkpoint функции build_dicts: записывает
+    узлы и рёбра топа в подпапку <path_w>/top-<N>/ (см. write_variants).
+
+    :param path_w: путь к папке для записи
+    :param nodes_cut: см. функцию write_node_dict
+    :param edges_cut: см. функцию write_edge_dict
+    :return: функция вида f(N, node_dict, edge_dict)
+    """
+    def write_checkpoint(top, node_dict, edge_dict):
+        # write_node_dict дописывает в узлы поле 'parts', а словарь узлов
+        # ещё продолжит считаться
+        node_dict = {lex: dict(info) for lex, info in node_dict.items()}
+        write_variants({'top-%d' % top: (node_dict, edge_dict)}, path_w,
+                       nodes_cut, edges_cut)
+    return write_checkpoint
+
+
+def file_name_of(file_r):
+    """
+    Возвращает имя файла на диске, если file_r - открытый обычный файл,
+    иначе None (например, для списка строк или стандартного ввода).
+    """
+    name = getattr(file_r, 'name', None)
+    if isinstance(name, str) and os.path.isfile(name):
+        return name
+    return None
+
+
+def split_file(file_name, parts):
+    """
+    Делит файл на parts диапазонов байтов по границам строк.
+
+    :param file_name: имя файла
+    :param parts: количество диапазонов
+    :return: список кортежей (начало, конец, номер первой строки диапазона,
+    количество строк в диапазоне)
+    """
+    size = os.path.getsize(file_name)
+    offsets = [0]
+    with open(file_name, 'rb') as file_r:
+        for part in range(1, parts):
+            position = max(size * part // parts, offsets[-1])
+            if position > 0:
+                # переходим к началу следующей строки
+                file_r.seek(position - 1)
+                file_r.readline()
+                position = file_r.tell()
+            offsets.append(min(position, size))
+        offsets.append(size)
+
+        # считаем строки, чтобы сопоставить диапазоны с весами
+        shards = []
+        line_number = 0
+        file_r.seek(0)
+        for (start, end) in zip(offsets, offsets[1:]):
+            first_line = line_number
+            left = end - start
+            chunk = b''
+            while left > 0:
+                chunk = file_r.read(min(left, 1 << 20))
+                line_number += chunk.count(b'\n')
+                left -= len(chunk)
+            # последняя строка файла может быть без перевода строки
+            if chunk and not chunk.endswith(b'\n'):
+                line_number += 1
+            shards.append((start, end, first_line, line_number - first_line))
+
+    return shards
+
+
+def read_range(file_name, start, end):
+    """
+    Генератор строк файла из диапазона байтов [start, end).
+    """
+    with open(file_name, 'rb') as file_r:
+        file_r.seek(start)
+        position = start
+        while position < end:
+            line = file_r.readline()
+            if not line:
+                break
+            position += len(line)
+            yield line.decode('utf-8')
+
+
+def count_shard(args):
+    """
+    Подсчёт узлов и/или рёбер в одном диапазоне файла (выполняется в
+    отдельном процессе, см. build_parallel). Результаты раскладываются по
+    корзинам по хэшу леммы или пары и записываются во временные файлы
+    (см. bucket_file_name), чтобы потом сливать каждую корзину отдельно,
+    не передавая частичные счётчики через родительский процесс.
+
+    :return: файл с леммами диапазона или None
+    """
+    (file_name, start, end, weights, include_bastard, include_non_cyrillic,
+     what, shard, buckets, work_dir, lems, window, max_pairs,
+     word_filter) = args
+    lines = read_range(file_name, start, end)
+    node_dict = {}
+    edge_dict = {}
+    file_lems_name = None
+
+    if what == 'nodes':
+        node_dict = build_node_dict(lines, weights, include_bastard,
+                                    include_non_cyrillic,
+                                    word_filter=word_filter)
+    elif what == 'edges':
+        edge_dict = build_edge_dict(lines, weights, include_bastard,
+                                    include_non_cyrillic, window=window,
+                                    max_pairs=max_pairs,
+                                    word_filter=word_filter)
+    elif not lems:
+        node_dict, edge_dict = build_dicts(lines, weights, include_bastard,
+                                           include_non_cyrillic,
+                                           window=window, max_pairs=max_pairs,
+                                           word_filter=word_filter)
+    else:
+        (fd, file_lems_name) = tempfile.mkstemp(suffix='.txt', dir=work_dir)
+        with open(fd, 'w') as file_lems:
+            node_dict, edge_dict = build_dicts(lines, weights,
+                                               include_bastard,
+                                               include_non_cyrillic,
+                                               file_lems=file_lems,
+                                               window=window,
+                                               max_pairs=max_pairs,
+                                               word_filter=word_filter)
+
+    if what != 'edges':
+        node_buckets = [{} for _ in range(buckets)]
+        for lex, info in node_dict.items():
+            node_buckets[bucket_of(lex, buckets)][lex] = info
+        del node_dict
+        dump_buckets(work_dir, 'nodes', shard, node_buckets)
+        del node_buckets
+    if what != 'nodes':
+        edge_buckets = [{} for _ in range(buckets)]
+        for pair, count in edge_dict.items():
+            edge_buckets[bucket_of('\t'.join(pair), buckets)][pair] = count
+        del edge_dict
+        dump_buckets(work_dir, 'edges', shard, edge_buckets)
+
+    return file_lems_name
+
+
+def bucket_file_name(work_dir, kind, bucket, shard):
+    """
+    Имя временного файла с корзиной bucket узлов или рёбер (kind) диапазона
+    номер shard.
+    """
+    return '%s/%s-%d-%d.pickle' % (work_dir, kind, bucket, shard)
+
+
+def dump_buckets(work_dir, kind, shard, buckets):
+    """
+    Записывает корзины одного диапазона во временные файлы.
+    """
+    for (bucket, part) in enumerate(buckets):
+        with open(bucket_file_name(work_dir, kind, bucket, shard),
+                  'wb') as file_w:
+            pickle.dump(part, file_w, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def load_bucket_parts(work_dir, kind, bucket, shards):
+    """
+    Генератор: читает корзину из файлов всех диапазонов по порядку,
+    прочитанные файлы удаляются.
+    """
+    for shard in range(shards):
+        file_name = bucket_file_name(work_dir, kind, bucket, shard)
+        with open(file_name, 'rb') as file_r:
+            part = pickle.load(file_r)
+        os.remove(file_name)
+        yield part
+
+
+def merge_bucket(args):
+    """
+    Сливает одну корзину узлов или рёбер из файлов всех диапазонов
+    (выполняется в отдельном процессе, см. build_parallel). В памяти
+    держатся только слитая корзина и часть одного диапазона.
+
+    :return: слитая корзина (см. merge_node_bucket и merge_edge_bucket)
+    """
+    (work_dir, kind, bucket, shards) = args
+    parts = load_bucket_parts(work_dir, kind, bucket, shards)
+    if kind == 'nodes':
+        return merge_node_bucket(parts)
+    return merge_edge_bucket(parts)
+
+
+def bucket_of(key, buckets):
+    """
+    Номер корзины для строки. Используется crc32, а не hash(), т.к. hash()
+    строк различается в разных процессах.
+    """
+    return zlib.crc32(key.encode('utf-8')) % buckets
+
+
+def merge_node_bucket(parts):
+    """
+    Сливает словари узлов одной корзины из разных диапазонов. Диапазоны
+    передаются в порядке следования в файле, поэтому, как и при
+    последовательном подсчёте, атрибуты узла берутся из первого вхождения,
+    а порядок частей речи сохраняется.
+    """
+    merged = {}
+    for part in parts:
+        for lex, info in part.items():
+            if lex not in merged:
+                merged[lex] = info
                 continue
-            part_speech = word['part_speech']
-            if lex not in node_dict:
-                node_dict[lex] = word
-                node_dict[lex]['count'] = 0
-                node_dict[lex]['part_speech'] = Counter()
+            merged[lex]['count'] += info['count']
+            merged[lex]['part_speech'].update(info['part_speech'])
+    return merged
 
-            node_dict[lex]['count'] += int(weight)
-            node_dict[lex]['part_speech'][part_speech] += int(weight)
-            lexs_unique.append(lex)
 
-    return node_dict
+def merge_edge_bucket(parts):
+    """
+    Сливает счётчики рёбер одной корзины из разных диапазонов.
+    """
+    merged = Counter()
+    for part in parts:
+        merged.update(part)
+    return merged
 
 
-def write_edge_dict(file_w, edge_dict, sep=';', cut=0, edge_type='Undirected'):
+def build_parallel(file_json, weights=None,
+                   include_bastard=True, include_non_cyrillic=True,
+                   workers=2, what='both', file_lems=None, window=None,
+                   max_pairs=None, word_filter=None):
+    """
+    Многопроцессный подсчёт узлов и рёбер. Файл делится на диапазоны байтов,
+    каждый диапазон обрабатывается в отдельном процессе и раскладывает свои
+    счётчики по корзинам (по хэшу леммы или пары) во временные файлы. Затем
+    каждая корзина сливается в отдельном процессе, и в текущий процесс
+    возвращаются только слитые корзины. Результат совпадает с
+    последовательным подсчётом.
+
+    :param file_json: открытый файл с json-выводом Mystem (нужно имя файла)
+    :param weights: файл с весами запросов (см. build_edge_dict)
+    :param include_bastard: смотри lem_filter
+    :param include_non_cyrillic: смотри lem_filter
+    :param workers: количество процессов
+    :param what: что считать: 'nodes', 'edges' или 'both'
+    :param file_lems: см. build_dicts (только для what='both')
+    :param window: рёбра только в окне слов (см. build_edge_dict)
+    :param max_pairs: ограничение пар на строку (см. build_edge_dict)
+    :param word_filter: дополнительные правила отбора лемм (см. lem_filter)
+    :return: кортеж (node_dict, edge_dict); не запрошенный словарь пустой
+    """
+    file_name = file_name_of(file_json)
+    # диапазонов больше, чем процессов, чтобы выровнять нагрузку
+    shards = split_file(file_name, workers * 4)
+    if weights is not None:
+        weights = list(weights)
+        # пустые строки в конце файла с весами пропускаем (см.
+        # weighted_lines)
+        while weights and is_blank(weights[-1]):
+            weights.pop()
+        weights = [int(weight) for weight in weights]
+        lines_count = sum(shard[3] for shard in shards)
+        if len(weights) != lines_count:
+            raise ValueError('Количество весов (%d) не совпадает с '
+                             'количеством строк (%d)' %
+                             (len(weights), lines_count))
+    # корзин больше, чем процессов, чтобы слияние одной корзины занимало
+    # меньше памяти
+    buckets = workers * 4
+    work_dir = tempfile.mkdtemp()
+
+    tasks = []
+    for (shard, (start, end, first_line, count)) in enumerate(shards):
+        shard_weights = None
+        if weights is not None:
+            shard_weights = weights[first_line:first_line + count]
+        tasks.append((file_name, start, end, shard_weights, include_bastard,
+                      include_non_cyrillic, what, shard, buckets, work_dir,
+                      file_lems is not None, window, max_pairs, word_filter))
+
+    node_dict = {}
+    edge_dict = Counter()
+    try:
+        with Pool(workers) as pool:
+            files_lems = pool.map(count_shard, tasks)
+
+            # корзины не пересекаются, поэтому их можно просто объединить
+            if what != 'edges':
+                for bucket in pool.imap(merge_bucket, [
+                        (work_dir, 'nodes', bucket, len(shards))
+                        for bucket in range(buckets)]):
+                    node_dict.update(bucket)
+            if what != 'nodes':
+                for bucket in pool.imap(merge_bucket, [
+                        (work_dir, 'edges', bucket, len(shards))
+                        for bucket in range(buckets)]):
+                    dict.update(edge_dict, bucket)
+
+        if file_lems is not None:
+            for file_lems_name in files_lems:
+                with open(file_lems_name, 'r') as file_part:
+                    shutil.copyfileobj(file_part, file_lems)
+    finally:
+        shutil.rmtree(work_dir)
+
+    return node_dict, edge_dict
+
+
+def write_edge_dict(file_w, edge_dict, sep=';', cut=0, edge_type='Undirected',
+                    max_items=None):
     """
     Функция сортирует счётчик рёбер по убыванию веса и записывает в файл.
     Файл пригоден для импорта в Gephi: http://gephi.github.io/
 
     :param file_w: файл для записи
-    :param edge_dict: счётчик рёбер, возвращаемый функцией build_edge_dict
+    :param edge_dict: счётчик рёбер, возвращаемый функцией build_edge_dict,
+    или граф, возвращаемый функцией build_graph
     :param sep: разделитель столбцов (по умолчанию ';')
     :param cut: не записывать рёбра с весом меньше, чем cut (по умолчанию 0)
     :param edge_type: тип рёбер (по умолчанию 'Undirected')
+    :param max_items: если указан, то сортировка выполняется с выгрузкой на
+    диск порциями по max_items рёбер (см. lem_spill.sort_by_weight). Для
+    SpillCounter используется всегда
     """
     # строка заголовков
     print('Weight', 'Source', 'Target', 'Type', sep=sep, file=file_w)
 
+    if isinstance(edge_dict, CompactGraph):
+        for source, target, count in edge_dict.edge_rows(cut):
+            print(count, source, target, edge_type, sep=sep, file=file_w)
+        return
+
     # сортируем счётчик по убыванию веса рёбер
-    edges_list = sorted(edge_dict.items(), key=lambda x: (x[1] * (-1), x[0]))
+    if isinstance(edge_dict, SpillCounter) or max_items:
+        edges_list = sort_by_weight(
+            (item for item in edge_dict.items() if item[1] >= cut),
+            max_items or edge_dict.max_items)
+    else:
+        edges_list = sorted(edge_dict.items(),
+                            key=lambda x: (x[1] * (-1), x[0]))
     # записываем в файл
     for edge, count in edges_list:
         if count < cut:
@@ -282,7 +1569,8 @@ def write_node_dict(file_w, node_dict, sep=';', cut=0):
     Файл пригоден для импорта в Gephi: http://gephi.github.io/
 
     :param file_w: файл для записи
-    :param node_dict: счётчик узлов, возвращаемый функцией build_node_dict
+    :param node_dict: счётчик узлов, возвращаемый функцией build_node_dict,
+    или граф, возвращаемый функцией build_graph
     :param sep: разделитель столбцов (по умолчанию ';')
     :param cut: не записывать узлы с весом меньше, чем cut (по умолчанию 0)
     """
@@ -290,6 +1578,13 @@ def write_node_dict(file_w, node_dict, sep=';', cut=0):
     print('Count', 'Id', 'Label', 'Type', 'Bastard', 'Non-cyrillic',
           sep=sep, file=file_w)
 
+    if isinstance(node_dict, CompactGraph):
+        for node, count, parts, bastard, non_cyrillic in \
+                node_dict.node_rows(cut):
+            print(count, node, node, parts, bastard, non_cyrillic,
+                  sep=sep, file=file_w)
+        return
+
     # разрешаем конфликты множества частей речи
     node_dict = part_speech_conflict_resolution(node_dict)
 
@@ -325,12 +1620,167 @@ def part_speech_conflict_resolution(node_dict):
     return node_dict
 
 
+def data_checksum(file_name, offset):
+    """
+    Контрольная сумма последних (до 4 КБ) байтов файла перед позицией offset.
+    Позволяет проверить, что уже обработанная часть файла не изменилась.
+    """
+    with open(file_name, 'rb') as file_r:
+        start = max(offset - 4096, 0)
+        file_r.seek(start)
+        return zlib.crc32(file_r.read(offset - start))
+
+
+def load_state(file_state_name, file_data_name, settings):
+    """
+    Загружает сохранённое состояние инкрементальной сборки графа
+    (см. make_gephi_files). Состояние отбрасывается, если его нет, если
+    изменились настройки или если уже обработанная часть файла с данными
+    изменилась (файл разрешается только дописывать).
+
+    :param file_state_name: файл состояния
+    :param file_data_name: файл с данными
+    :param settings: словарь настроек, с которыми собирался граф
+    :return: словарь состояния или None
+    """
+    if not os.path.exists(file_state_name):
+        return None
+    with open(file_state_name, 'rb') as file_state:
+        state = pickle.load(file_state)
+
+    if state.get('settings') != settings:
+        return None
+    if os.path.getsize(file_data_name) < state['offset']:
+        return None
+    if data_checksum(file_data_name, state['offset']) != state['checksum']:
+        return None
+
+    with open(file_data_name, 'rb') as file_data:
+        if state['offset'] > 0:
+            file_data.seek(state['offset'] - 1)
+            if file_data.read(1) != b'\n':
+                # последняя обработанная строка была без перевода строки:
+                # дописанный перевод строки пропускаем, а продолжение самой
+                # строки означает, что она изменилась
+                line = file_data.readline()
+                if line.strip(b'\r\n'):
+                    return None
+                state['offset'] += len(line)
+    return state
+
+
+def save_state(file_state_name, file_data_name, settings, rows, offset,
+               node_dict, edge_dict):
+    """
+    Сохраняет состояние инкрементальной сборки графа: словари узлов и рёбер
+    и отметку обработанной части файла с данными (количество строк и
+    позицию в байтах). Файл заменяется атомарно.
+    """
+    state = {
+        'settings': settings,
+        'rows': rows,
+        'offset': offset,
+        'checksum': data_checksum(file_data_name, offset),
+        'nodes': node_dict,
+        'edges': edge_dict,
+    }
+    file_tmp_name = file_state_name + '.tmp'
+    with open(file_tmp_name, 'wb') as file_state:
+        pickle.dump(state, file_state, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(file_tmp_name, file_state_name)
+
+
+def build_stream(file_data_name, query_column=1, weight_column=None,
+                 sep='\t', headers=False, mystem='/Applications/mystem',
+                 params=None, bastard=True, non_cyrillic=True, cache=None,
+                 workers=None, edges_budget=None, edges_max_items=None,
+                 edges_window=None, edges_max_pairs=None, sparse_cut=None,
+                 saved=None, files_debug=None, stage=None, word_filter=None,
+                 dedup=False, checkpoints=None, on_checkpoint=None):
+    """
+    Потоковый режим make_gephi_files: файл с данными -> Mystem -> словари
+    узлов и рёбер без промежуточных файлов (см. read_columns и lem_rows).
+
+    :param workers: количество процессов Mystem (см. MystemPool)
+    :param sparse_cut: если указан (не None), то рёбра считаются через
+    разреженные матрицы с этим порогом веса (см. build_dicts)
+    :param saved: сохранённое состояние (см. load_state): чтение начинается
+    с отметки обработанной части файла
+    :param files_debug: имена файлов запросов, весов, вывода Mystem и лемм
+    для отладки (по умолчанию не записываются)
+    :param stage: замер этапа (см. параметр stage функции build_dicts)
+    :param word_filter: дополнительные правила отбора лемм (см. lem_filter)
+    :param dedup: схлопнуть дубли запросов перед Mystem (см. dedup_rows).
+    Файл с данными при этом читается целиком до начала лемматизации
+    :param checkpoints: промежуточные результаты по топам (см. build_dicts)
+    :param on_checkpoint: см. build_dicts
+    :return: кортеж (node_dict, edge_dict, количество обработанных строк,
+    позиция в байтах после последней обработанной строки)
+    """
+    progress = {'rows': 0, 'offset': 0}
+    if saved:
+        progress = {'rows': saved['rows'], 'offset': saved['offset']}
+
+    def data_rows():
+        for ((query, weight), end) in read_columns(
+                file_data_name, [query_column, weight_column], sep, headers,
+                progress['offset']):
+            progress['rows'] += 1
+            progress['offset'] = end
+            yield query, weight if weight_column else 1
+
+    with ExitStack() as stack:
+        files = [None] * 4
+        if files_debug:
+            # как и в обычном режиме: в инкрементальном режиме леммы
+            # дописываются, остальные файлы содержат только новые строки
+            modes = ('w', 'w', 'w', 'a' if saved else 'w')
+            files = [stack.enter_context(open(name, mode))
+                     for name, mode in zip(files_debug, modes)]
+        lem_cache = None
+        if cache:
+            lem_cache = stack.enter_context(LemCache(cache, params))
+        rows = data_rows()
+        file_lems = files[3]
+        if dedup:
+            (rows, row_ids) = dedup_rows(rows)
+            if file_lems is not None:
+                # леммы уникальных запросов потом разворачиваются по строкам
+                file_lems = io.StringIO()
+        (json_lines, weights) = lem_rows(
+            rows, mystem, params, lem_cache, workers,
+            file_query=files[0], file_weight=files[1], file_json=files[2])
+        node_dict, edge_dict = build_dicts(json_lines, weights,
+                                           include_bastard=bastard,
+                                           include_non_cyrillic=non_cyrillic,
+                                           file_lems=file_lems,
+                                           budget=edges_budget,
+                                           max_items=edges_max_items,
+                                           window=edges_window,
+                                           max_pairs=edges_max_pairs,
+                                           sparse=sparse_cut is not None,
+                                           sparse_cut=sparse_cut or 0,
+                                           stage=stage,
+                                           word_filter=word_filter,
+                                           checkpoints=checkpoints,
+                                           on_checkpoint=on_checkpoint)
+        if dedup and file_lems is not None:
+            expand_lines(file_lems.getvalue().splitlines(True), row_ids,
+                         files[3])
+    return node_dict, edge_dict, progress['rows'], progress['offset']
+
+
 def make_gephi_files(file_data_name='data/input.txt',
                      path_r='data/', path_w='output/',
                      query_column=1, weight_column=None, sep='\t',
                      headers=False, mystem='/Applications/mystem',
                      bastard=True, non_cyrillic=True,
-                     nodes_cut=0, edges_cut=0):
+                     nodes_cut=0, edges_cut=0, cache=None, workers=None,
+                     edges_budget=None, edges_max_items=None, state=None,
+                     edges_window=None, edges_max_pairs=None, stream=False,
+                     intermediate=False, json_format='pretty',
+                     snapshot=False, edges_sparse=False, recorder=None,
+                     word_filter=None, dedup=False, top=None):
     """
     Функция верхнего уровня для создания файлов узлов и рёбер для Gephi.
     Позволяет сделать всё "в один клик" с настройками по умолчанию.
@@ -350,11 +1800,82 @@ def make_gephi_files(file_data_name='data/input.txt',
     :param non_cyrillic: см. функцию lem_filter
     :param nodes_cut: см. функцию write_node_dict
     :param edges_cut: см. функцию write_edge_dict
+    :param cache: файл кэша лемматизации (по умолчанию отсутствует). Если
+    указан, то через Mystem прогоняются только запросы, которых нет в кэше
+    (см. функцию lem_cached)
+    :param workers: количество процессов для подсчёта узлов и рёбер
+    (см. функцию build_parallel). Вне потокового режима несовместим
+    с edges_budget, edges_max_items, edges_sparse и top
+    :param edges_budget: приближённый подсчёт рёбер в ограниченной памяти
+    (см. параметр budget функции build_edge_dict)
+    :param edges_max_items: подсчёт рёбер с выгрузкой на диск
+    (см. параметр max_items функции build_edge_dict)
+    :param state: файл состояния для инкрементального режима (по умолчанию
+    отсутствует). Если указан, то словари узлов и рёбер сохраняются в нём
+    вместе с отметкой обработанных строк. При следующем запуске через Mystem
+    прогоняются и подсчитываются только дописанные в конец файла с данными
+    строки, а результат совпадает с полной пересборкой. В файлы запросов,
+    весов и lems.json при этом попадают только новые строки. Несовместим
+    с edges_budget и edges_max_items
+    :param edges_window: рёбра только между леммами в окне слов, для длинных
+    текстов (см. параметр window функции build_edge_dict)
+    :param edges_max_pairs: ограничение количества пар на строку
+    (см. параметр max_pairs функции build_edge_dict)
+    :param stream: потоковый режим (по умолчанию False): файл с данными
+    читается один раз через mmap, запросы сразу подаются в Mystem (см.
+    lem_rows), а узлы и рёбра считаются прямо из вывода Mystem. Файлы
+    запросов, весов, lems.json и lems.txt при этом не создаются, а workers
+    задаёт количество процессов Mystem
+    :param intermediate: в потоковом режиме всё же записывать файлы
+    запросов, весов, lems.json и lems.txt (для отладки)
+    :param json_format: формат файлов узлов и рёбер в json: 'pretty' -
+    nodes.json и edges.json (по умолчанию), 'ndjson' - потоковая запись
+    nodes.ndjson и edges.ndjson по одному объекту на строку, None - не
+    записывать
+    :param snapshot: записать двоичный снимок графа graph.bin (см.
+    lem_snapshot.Snapshot)
+    :param edges_sparse: считать рёбра через разреженные матрицы (см.
+    параметр sparse функции build_dicts, нужны numpy и scipy); рёбра с весом
+    меньше edges_cut отбрасываются сразу. Несовместим с state
+    :param recorder: замеры этапов (см. lem_profile.Recorder): время,
+    строки и пары в секунду, пиковая память. По умолчанию не ведутся
+    :param word_filter: дополнительные правила отбора лемм: части речи,
+    стоп-леммы, регулярные выражения, минимальная длина (словарь правил или
+    lem_filters.WordFilter, см. lem_filters.DEFAULT_SPEC)
+    :param dedup: схлопнуть дубли запросов (пробелы, регистр кириллических
+    букв) перед Mystem с суммированием весов (см. dedup_rows). В Mystem
+    уходят только уникальные запросы, поэтому файлы запросов, весов и
+    lems.json содержат по строке на уникальный запрос, а lems.txt - по-прежнему
+    по строке на каждую строку с данными. Узлы и рёбра совпадают с подсчётом
+    без dedup, если Mystem одинаково разбирает запросы, которые отличаются
+    только регистром кириллических букв
+    :param top: список количеств строк N: за тот же проход узлы и рёбра
+    первых N строк записываются в папку path_w/top-N/ (см. параметр
+    checkpoints функции build_dicts). При dedup считаются первые N
+    уникальных запросов. Несовместим с state
     """
+    if state and (edges_budget or edges_max_items or edges_sparse or top):
+        raise ValueError('Инкрементальный режим (state) несовместим с '
+                         'edges_budget, edges_max_items, edges_sparse '
+                         'и top')
+    if not stream and workers and workers > 1 and \
+            (edges_budget or edges_max_items or edges_sparse or top):
+        raise ValueError('Параллельный подсчёт (workers) несовместим с '
+                         'edges_budget, edges_max_items, edges_sparse и top')
+    if json_format not in ('pretty', 'ndjson', None):
+        raise ValueError('Неизвестный формат json_format: %s' % json_format)
+
     if not os.path.exists(path_r):
         os.makedirs(path_r)
     if not os.path.exists(path_w):
         os.makedirs(path_w)
+    if recorder is None:
+        recorder = NullRecorder()
+    if word_filter is not None and not isinstance(word_filter, WordFilter):
+        word_filter = WordFilter(word_filter)
+    on_checkpoint = None
+    if top:
+        on_checkpoint = checkpoint_writer(path_w, nodes_cut, edges_cut)
 
     # Параметры по умолчанию
     params = ['-cldige', 'utf-8', '--format', 'json']
@@ -366,70 +1887,168 @@ def make_gephi_files(file_data_name='data/input.txt',
     file_json_name = path_w + 'lems.json'
     file_nodes_name = path_w + 'nodes.csv'
     file_edges_name = path_w + 'edges.csv'
+    file_snapshot_name = path_w + 'graph.bin'
+
+    # Настройки, при изменении которых нельзя продолжать с сохранённого
+    # состояния
+    settings = {'query_column': query_column, 'weight_column': weight_column,
+                'sep': sep, 'headers': headers, 'params': params,
+                'bastard': bastard, 'non_cyrillic': non_cyrillic,
+                'edges_window': edges_window,
+                'edges_max_pairs': edges_max_pairs,
+                'word_filter': word_filter.spec if word_filter else None,
+                'dedup': dedup}
+    saved = None
+    if state:
+        saved = load_state(state, file_data_name, settings)
+
+    if stream:
+        with recorder.stage('stream') as stage:
+            (node_dict, edge_dict, rows, offset) = build_stream(
+                file_data_name, query_column, weight_column, sep, headers,
+                mystem, params, bastard, non_cyrillic, cache, workers,
+                edges_budget, edges_max_items, edges_window, edges_max_pairs,
+                edges_cut if edges_sparse else None,
+                saved, [file_query_name, file_weight_name, file_json_name,
+                        file_lems_name] if intermediate else None, stage,
+                word_filter, dedup, top, on_checkpoint)
+    else:
+        # Сохраняем столбцы с запросами и весами в отдельные файлы
+        # (в инкрементальном режиме - только новые строки)
+        rows = 0  # количество обработанных строк с данными
+        new_rows = 0  # из них строк, обработанных при этом запуске
+        queries = 0  # запросов для Mystem (меньше new_rows, если dedup)
+        with recorder.stage('columns') as stage, \
+                open(file_data_name, 'rb') as file_data, \
+                open(file_query_name, 'w') as file_query, \
+                open(file_weight_name, 'w') as file_weight:
+            if saved:
+                rows = saved['rows']
+                file_data.seek(saved['offset'])
+            elif headers:
+                next(file_data)
+            data = (line.decode('utf-8').rstrip('\r\n').split(sep)
+                    for line in file_data)
+            data = ((line[query_column - 1],
+                     line[weight_column - 1] if weight_column else 1)
+                    for line in data)
+            if dedup:
+                (data, row_ids) = dedup_rows(data)
+            for (query, weight) in data:
+                print(query, file=file_query)
+                print(weight, file=file_weight)
+                queries += 1
+            new_rows = len(row_ids) if dedup else queries
+            rows += new_rows
+            offset = file_data.tell()
+            if stage is not None:
+                stage.add(new_rows)
+
+        # Прогоняем через леммер; ход работы учитываем по мере получения
+        # строк вывода Mystem
+        with recorder.stage('mystem', queries) as stage, \
+                open(file_query_name, 'r') as file_query, \
+                open(file_json_name, 'w') as file_json:
+            if cache:
+                with LemCache(cache, params) as lem_cache:
+                    write_lem_lines(lem_cached(file_query, lem_cache,
+                                               mystem=mystem),
+                                    file_json, stage)
+            else:
+                write_lem_lines(lem_output(file_query, mystem=mystem,
+                                           params=params),
+                                file_json, stage)
+
+        # Создаём словари узлов и рёбер за один проход по json-файлу и
+        # заодно сохраняем список лемм для каждой исходной строки (для
+        # проверки)
+        with recorder.stage('build', queries) as stage, \
+                open(file_json_name, 'r') as file_json, \
+                open(file_weight_name, 'r') as file_weight, \
+                open(file_lems_name, 'a' if saved else 'w') as file_lems:
+            file_lems_unique = io.StringIO() if dedup else file_lems
+            node_dict, edge_dict = build_dicts(
+                file_json, weights=file_weight, include_bastard=bastard,
+                include_non_cyrillic=non_cyrillic,
+                file_lems=file_lems_unique,
+                workers=workers,
+                budget=edges_budget, max_items=edges_max_items,
+                window=edges_window, max_pairs=edges_max_pairs,
+                sparse=edges_sparse, sparse_cut=edges_cut, stage=stage,
+                word_filter=word_filter, checkpoints=top,
+                on_checkpoint=on_checkpoint)
+            if dedup:
+                # леммы уникальных запросов разворачиваем по строкам
+                expand_lines(file_lems_unique.getvalue().splitlines(True),
+                             row_ids, file_lems)
+
+    with ExitStack() as stack:
+        # временные файлы SpillCounter удаляются и при ошибке
+        if isinstance(edge_dict, SpillCounter):
+            stack.enter_context(edge_dict)
+
+        # Добавляем новые строки к сохранённому состоянию
+        if state:
+            with recorder.stage('state'):
+                if saved:
+                    node_dict = merge_node_bucket([saved['nodes'], node_dict])
+                    saved['edges'].update(edge_dict)
+                    edge_dict = saved['edges']
+                save_state(state, file_data_name, settings, rows, offset,
+                           node_dict, edge_dict)
+
+        # Сохраняем словари в json-файлы
+        if json_format:
+            with recorder.stage('json'):
+                write_json_files(node_dict, edge_dict, json_format, path_w)
+
+        if snapshot:
+            with recorder.stage('snapshot'):
+                write_snapshot(file_snapshot_name, node_dict, edge_dict)
+
+        # Записываем словари для Gephi (с сортировкой по весу)
+        with recorder.stage('csv'):
+            # Узлы
+            with open(file_nodes_name, 'w') as file_nodes:
+                write_node_dict(file_nodes, node_dict, sep=';', cut=nodes_cut)
+
+            # Рёбра
+            with open(file_edges_name, 'w') as file_edges:
+                write_edge_dict(file_edges, edge_dict, sep=';', cut=edges_cut)
+
+
+def write_json_files(node_dict, edge_dict, json_format, path_w):
+    """
+    Сохраняет словари узлов и рёбер в json-файлы (см. параметр json_format
+    функции make_gephi_files).
+    """
     file_nodes_json_name = path_w + 'nodes.json'
     file_edges_json_name = path_w + 'edges.json'
-
-    # Сохраняем столбцы с запросами и весами в отдельные файлы
-    with open(file_data_name, 'r') as file_data, \
-            open(file_query_name, 'w') as file_query, \
-            open(file_weight_name, 'w') as file_weight:
-        if headers:
-            next(file_data)
-        for line in file_data:
-            line = line.rstrip('\n').split(sep)
-            print(line[query_column - 1], file=file_query)
-            if weight_column:
-                print(line[weight_column - 1], file=file_weight)
+    file_nodes_ndjson_name = path_w + 'nodes.ndjson'
+    file_edges_ndjson_name = path_w + 'edges.ndjson'
+    if json_format == 'pretty':
+        # Узлы
+        with open(file_nodes_json_name, 'w') as file_nodes_json:
+            pretty_json(node_dict, file_nodes_json)
+
+        # Рёбра
+        with open(file_edges_json_name, 'w') as file_edges_json:
+            if isinstance(edge_dict, SpillCounter):
+                edges = ((' - '.join(edge), count)
+                         for edge, count in edge_dict.items())
+                pretty_json_items(edges, file_edges_json)
             else:
-                print(1, file=file_weight)
-
-    # Прогоняем через леммер
-    with open(file_query_name, 'r') as file_query, \
-            open(file_json_name, 'w') as file_json:
-        lem(file_query, file_json, mystem=mystem, params=params)
-
-    # Список лемм для каждой исходной строки (для проверки)
-    with open(file_json_name, 'r') as file_json, \
-            open(file_lems_name, 'w') as file_lems:
-        for line in file_json:
-            line_parse = json_parse(line)
-            words = lem_filter(line_parse, include_bastard=bastard,
-                               include_non_cyrillic=non_cyrillic)
-            lems = [word['lex'] for word in words]
-            print(' '.join(lems), file=file_lems)
-
-    # Создаём словари узлов и рёбер
-    # Узлы
-    with open(file_json_name, 'r') as file_json, \
-            open(file_weight_name, 'r') as file_weight:
-        node_dict = build_node_dict(file_json, weights=file_weight,
-                                    include_bastard=bastard,
-                                    include_non_cyrillic=non_cyrillic)
-    # Рёбра
-    with open(file_json_name, 'r') as file_json, \
-            open(file_weight_name, 'r') as file_weight:
-        edge_dict = build_edge_dict(file_json, weights=file_weight,
-                                    include_bastard=bastard,
-                                    include_non_cyrillic=non_cyrillic)
-
-    # Сохраняем словари в json-файлы
-    # Узлы
-    with open(file_nodes_json_name, 'w') as file_nodes_json:
-        pretty_json(node_dict, file_nodes_json)
-
-    # Рёбра
-    with open(file_edges_json_name, 'w') as file_edges_json:
-        edges = {' - '.join(edge): count for edge, count in edge_dict.items()}
-        pretty_json(edges, file_edges_json)
-
-    # Записываем словари для Gephi
-    # Узлы
-    with open(file_nodes_name, 'w') as file_nodes:
-        write_node_dict(file_nodes, node_dict, sep=';', cut=nodes_cut)
-
-    # Рёбра
-    with open(file_edges_name, 'w') as file_edges:
-        write_edge_dict(file_edges, edge_dict, sep=';', cut=edges_cut)
+                edges = {' - '.join(edge): count
+                         for edge, count in edge_dict.items()}
+                pretty_json(edges, file_edges_json)
+    elif json_format == 'ndjson':
+        with open(file_nodes_ndjson_name, 'w') as file_nodes_json:
+            write_ndjson(node_dict.values(), file_nodes_json)
+        with open(file_edges_ndjson_name, 'w') as file_edges_json:
+            write_ndjson(({'source': edge[0], 'target': edge[1],
+                           'weight': count}
+                          for edge, count in edge_dict.items()),
+                         file_edges_json)
 
 
 def main():
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3.5
+# -*- coding: utf-8 -*-
+
+"""
+Постоянный кэш результатов лемматизации на диске (SQLite). Позволяет не
+прогонять через Mystem повторно те запросы, которые уже встречались
+в предыдущих запусках.
+"""
+
+import re
+import sqlite3
+
+# Параметры запуска Mystem по умолчанию (как в make_gephi_files)
+DEFAULT_PARAMS = ['-cldige', 'utf-8', '--format', 'json']
+
+SPACES = re.compile(r'\s+')
+
+
+def normalize(text):
+    """
+    Нормализует запрос перед поиском в кэше: убирает пробельные символы по
+    краям и схлопывает повторяющиеся пробельные символы внутри строки.
+    Регистр не меняется, т.к. для не кириллических слов лемма берётся
+    из исходного текста (см. lem.lem_filter).
+
+    :param text: строка запроса
+    :return: нормализованная строка
+    """
+    return SPACES.sub(' ', text).strip()
+
+
+class LemCache:
+    """
+    Кэш вида {нормализованный запрос + параметры Mystem: json-вывод Mystem}.
+    Размер кэша ограничен: при переполнении удаляются записи, к которым дольше
+    всего не обращались. Считает попадания и промахи.
+
+    Пример:
+        with LemCache('cache.sqlite') as cache:
+            for line in lem.lem_cached(queries, cache):
+                ...
+            print(cache.stats())
+    """
+
+    def __init__(self, file_name, params=None, max_size=1000000):
+        """
+        :param file_name: файл базы данных SQLite
+        :param params: параметры запуска Mystem списком (входят в ключ кэша;
+        по умолчанию ['-cldige', 'utf-8', '--format', 'json'])
+        :param max_size: максимальное количество записей в кэше
+        """
+        if not params:
+            params = DEFAULT_PARAMS
+        self.params = list(params)
+        self.prefix = ' '.join(self.params) + '\t'
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self.db = sqlite3.connect(file_name)
+        self.db.execute('CREATE TABLE IF NOT EXISTS lems ('
+                        'key TEXT PRIMARY KEY, '
+                        'value TEXT NOT NULL, '
+                        'used INTEGER NOT NULL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS lems_used ON lems (used)')
+        (self.size, tick) = self.db.execute(
+            'SELECT COUNT(*), MAX(used) FROM lems').fetchone()
+        self.tick = tick or 0  # счётчик обращений (для вытеснения)
+        if self.size > self.max_size:
+            self.evict(self.size - self.max_size)
+            self.db.commit()
+
+    def key(self, text):
+        """
+        Ключ кэша для строки запроса.
+        """
+        return self.prefix + normalize(text)
+
+    def get_many(self, texts):
+        """
+        Ищет запросы в кэше.
+
+        :param texts: список строк запросов
+        :return: словарь вида {ключ: json-вывод Mystem} для найденных запросов
+        """
+        texts_keys = [self.key(text) for text in texts]
+        keys = list(set(texts_keys))
+        found = {}
+        # SQLite ограничивает количество параметров в одном запросе
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            placeholders = ','.join('?' * len(chunk))
+            found.update(self.db.execute(
+                'SELECT key, value FROM lems WHERE key IN (%s)' % placeholders,
+                chunk))
+
+        self.tick += 1
+        self.db.executemany('UPDATE lems SET used = ? WHERE key = ?',
+                            ((self.tick, key) for key in found))
+        for key in texts_keys:
+            if key in found:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+        return found
+
+    def put_many(self, items):
+        """
+        Сохраняет результаты лемматизации в кэш.
+
+        :param items: пары (строка запроса, json-вывод Mystem)
+        """
+        self.tick += 1
+        changes = self.db.total_changes
+        self.db.executemany(
+            'INSERT OR IGNORE INTO lems (key, value, used) VALUES (?, ?, ?)',
+            ((self.key(text), value, self.tick) for text, value in items))
+        self.size += self.db.total_changes - changes
+        if self.size > self.max_size:
+            self.evict(self.size - self.max_size)
+        self.db.commit()
+
+    def evict(self, count):
+        """
+        Удаляет count записей, к которым дольше всего не обращались.
+        """
+        self.db.execute('DELETE FROM lems WHERE key IN ('
+                        'SELECT key FROM lems ORDER BY used LIMIT ?)',
+                        (count,))
+        self.size -= count
+        self.evictions += count
+
+    def stats(self):
+        """
+        Статистика работы кэша.
+
+        :return: словарь вида {'hits': int, 'misses': int,
+        'evictions': int, 'size': int}
+        """
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'size': self.size}
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
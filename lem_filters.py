@@ -0,0 +1,148 @@
+#!/usr/bin/env python3.5
+# -*- coding: utf-8 -*-
+
+"""
+Настраиваемый отбор лемм. Правила задаются словарём (его можно хранить
+в json), который один раз компилируется в WordFilter:
+
+    word_filter = WordFilter({'parts_speech': ['S', 'A'],
+                              'grammemes': ['им'],
+                              'stop_lemmas': ['быть', 'весь'],
+                              'exclude': [r'^\\d+$'],
+                              'min_length': 2})
+    lem.make_gephi_files(..., word_filter=word_filter)
+
+Одни и те же леммы встречаются миллионы раз, поэтому решение запоминается
+для каждого ключа (лемма, часть речи, bastard), а решение по граммемам -
+для каждой строки грамматики.
+"""
+
+import re
+
+from lem_grammar import gr_match
+from lem_grammar import mask_of
+
+# Правила по умолчанию (ничего не отбрасывается)
+DEFAULT_SPEC = {
+    # оставлять леммы, в распознании которых Mystem не уверен
+    'bastard': True,
+    # оставлять слова без анализа (обычно не кириллические)
+    'non_cyrillic': True,
+    # список разрешённых частей речи (None - любые). Слова без анализа
+    # части речи не имеют и регулируются правилом non_cyrillic
+    'parts_speech': None,
+    # список граммем (см. lem_grammar.GRAMMEMES), которые должны быть
+    # в грамматике леммы, и список граммем, которых в ней быть не должно.
+    # При неоднозначном разборе граммемы проверяются внутри одного варианта
+    # (см. lem_grammar.gr_match). Слова без анализа не проверяются
+    'grammemes': None,
+    'exclude_grammemes': None,
+    # список отбрасываемых лемм (без учёта регистра)
+    'stop_lemmas': None,
+    # список регулярных выражений: лемма отбрасывается, если хотя бы одно
+    # из них находится в ней (re.search)
+    'exclude': None,
+    # минимальная длина леммы
+    'min_length': 0,
+}
+
+
+class WordFilter:
+    """
+    Скомпилированные правила отбора лемм (см. DEFAULT_SPEC). Вызов
+    word_filter(lex, part_speech, bastard, gr) возвращает True, если лемму
+    нужно оставить.
+    """
+
+    def __init__(self, spec=None, max_size=1000000):
+        """
+        :param spec: словарь правил, недостающие правила берутся из
+        DEFAULT_SPEC
+        :param max_size: максимальное количество запомненных решений (при
+        переполнении запомненные решения сбрасываются)
+        :raise ValueError: если в spec есть неизвестное правило или
+        неизвестная граммема
+        """
+        spec = dict(spec or {})
+        unknown = set(spec) - set(DEFAULT_SPEC)
+        if unknown:
+            raise ValueError('Unknown filter rules: %s' %
+                             ', '.join(sorted(unknown)))
+        self.spec = dict(DEFAULT_SPEC, **spec)
+        self.max_size = max_size
+        self.verdicts = {}
+        self.gr_verdicts = {}
+
+        self.bastard = bool(self.spec['bastard'])
+        self.non_cyrillic = bool(self.spec['non_cyrillic'])
+        self.parts_speech = None
+        if self.spec['parts_speech'] is not None:
+            self.parts_speech = frozenset(self.spec['parts_speech'])
+        self.stop_lemmas = frozenset(lex.lower() for lex in
+                                     self.spec['stop_lemmas'] or ())
+        self.exclude = None
+        if self.spec['exclude']:
+            self.exclude = re.compile('|'.join(
+                '(?:%s)' % pattern for pattern in self.spec['exclude']))
+        self.min_length = self.spec['min_length'] or 0
+        try:
+            self.required = mask_of(*self.spec['grammemes'] or ())
+            self.excluded = mask_of(*self.spec['exclude_grammemes'] or ())
+        except KeyError as error:
+            raise ValueError('Unknown grammeme: %s' % error.args[0])
+
+    def __call__(self, lex, part_speech, bastard, gr=None):
+        """
+        :param lex: лемма (для слов без анализа - исходный текст)
+        :param part_speech: часть речи (None для слов без анализа)
+        :param bastard: Mystem не уверен в распознании
+        :param gr: строка грамматики Mystem (None для слов без анализа)
+        :return: True, если лемму нужно оставить
+        """
+        key = (lex, part_speech, bastard)
+        verdict = self.verdicts.get(key)
+        if verdict is None:
+            verdict = self.check(lex, part_speech, bastard)
+            if len(self.verdicts) >= self.max_size:
+                self.verdicts.clear()
+            self.verdicts[key] = verdict
+        if not verdict or gr is None or \
+                not (self.required or self.excluded):
+            return verdict
+        verdict = self.gr_verdicts.get(gr)
+        if verdict is None:
+            verdict = self.check_gr(gr)
+            if len(self.gr_verdicts) >= self.max_size:
+                self.gr_verdicts.clear()
+            self.gr_verdicts[gr] = verdict
+        return verdict
+
+    def check(self, lex, part_speech, bastard):
+        """
+        Решение без запоминания.
+        """
+        if part_speech is None:
+            if not self.non_cyrillic:
+                return False
+        elif self.parts_speech is not None and \
+                part_speech not in self.parts_speech:
+            return False
+        if bastard and not self.bastard:
+            return False
+        if len(lex) < self.min_length:
+            return False
+        if self.stop_lemmas and lex.lower() in self.stop_lemmas:
+            return False
+        if self.exclude is not None and self.exclude.search(lex):
+            return False
+        return True
+
+    def check_gr(self, gr):
+        """
+        Решение по граммемам без запоминания.
+        """
+        return gr_match(gr, self.required, self.excluded)
+
+    def __reduce__(self):
+        # в другие процессы передаются только правила, без решений
+        return WordFilter, (self.spec, self.max_size)
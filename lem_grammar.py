@@ -0,0 +1,136 @@
+#!/usr/bin/env python3.5
+# -*- coding: utf-8 -*-
+
+"""
+Разбор строки грамматики Mystem (поле gr) в целочисленные битовые маски.
+Каждой граммеме соответствует свой бит (см. GRAMMEMES), поэтому проверка
+вида "существительное в именительном падеже" - это одно побитовое И:
+
+    required = mask_of('S', 'им')
+    gr_mask(gr) & required == required
+
+Неоднозначный разбор (a|b|c) даёт несколько вариантов грамматики: gr_masks
+возвращает маску для каждого варианта, gr_mask - их объединение. Список
+граммем: https://tech.yandex.ru/mystem/doc/grammemes-values-docpage/
+"""
+
+import re
+from functools import lru_cache
+
+# Граммемы Mystem по категориям. Номер бита граммемы - её номер в этом
+# списке, поэтому новые граммемы нужно добавлять только в конец
+GRAMMEMES = (
+    ('part_speech', ('A', 'ADV', 'ADVPRO', 'ANUM', 'APRO', 'COM', 'CONJ',
+                     'INTJ', 'NUM', 'PART', 'PR', 'S', 'SPRO', 'V')),
+    ('tense', ('наст', 'непрош', 'прош')),
+    ('case', ('им', 'род', 'дат', 'вин', 'твор', 'пр', 'парт', 'местн',
+              'зв')),
+    ('number', ('ед', 'мн')),
+    ('verb_form', ('деепр', 'инф', 'прич', 'изъяв', 'пов')),
+    ('adjective_form', ('кр', 'полн', 'притяж')),
+    ('degree', ('прев', 'срав')),
+    ('person', ('1-л', '2-л', '3-л')),
+    ('gender', ('муж', 'жен', 'сред')),
+    ('aspect', ('несов', 'сов')),
+    ('voice', ('действ', 'страд')),
+    ('animacy', ('од', 'неод')),
+    ('transitivity', ('пе', 'нп')),
+    ('other', ('вводн', 'гео', 'затр', 'имя', 'искаж', 'мж', 'обсц', 'отч',
+               'прдк', 'разг', 'редк', 'сокр', 'устар', 'фам')),
+)
+
+# граммема -> бит
+BITS = {}
+# категория -> маска всех её граммем
+CATEGORY_MASKS = {}
+for (category, names) in GRAMMEMES:
+    CATEGORY_MASKS[category] = 0
+    for name in names:
+        BITS[name] = 1 << len(BITS)
+        CATEGORY_MASKS[category] |= BITS[name]
+del category, names, name
+
+# бит граммем, которых нет в GRAMMEMES
+UNKNOWN = 1 << len(BITS)
+
+# группа неоднозначного разбора: (a|b|c)
+GROUP = re.compile(r'\(([^()]*)\)')
+SEPARATORS = re.compile(r'[,=]')
+
+
+def mask_of(*names):
+    """
+    Маска набора граммем: mask_of('S', 'им').
+
+    :raise KeyError: если граммемы нет в GRAMMEMES
+    """
+    mask = 0
+    for name in names:
+        mask |= BITS[name]
+    return mask
+
+
+def plain_mask(text):
+    """
+    Маска перечисления граммем через запятую или знак "равно" (без групп).
+    """
+    mask = 0
+    for name in SEPARATORS.split(text):
+        if name:
+            mask |= BITS.get(name, UNKNOWN)
+    return mask
+
+
+@lru_cache(maxsize=65536)
+def gr_masks(gr):
+    """
+    Маски всех вариантов грамматики. Граммемы вне скобок входят в каждый
+    вариант, группы (a|b|c) перемножаются. Результат кэшируется для каждой
+    строки gr.
+
+    :param gr: строка с грамматикой, например 'S,муж,неод=(вин,ед|им,ед)'
+    :return: кортеж масок вариантов без повторов (хотя бы одна маска)
+    """
+    masks = [plain_mask(GROUP.sub(',', gr))]
+    for group in GROUP.findall(gr):
+        alternatives = [plain_mask(text) for text in group.split('|')]
+        masks = [mask | alternative for mask in masks
+                 for alternative in alternatives]
+    return tuple(dict.fromkeys(masks))
+
+
+@lru_cache(maxsize=65536)
+def gr_mask(gr):
+    """
+    Объединение масок всех вариантов грамматики (см. gr_masks). Подходит
+    для проверки граммем, которые могут относиться к разным вариантам: для
+    'S,муж,неод=(вин,ед|им,ед)' проверка mask_of('S', 'им') пройдёт.
+    """
+    mask = 0
+    for variant in gr_masks(gr):
+        mask |= variant
+    return mask
+
+
+def gr_match(gr, required=0, excluded=0):
+    """
+    Есть ли вариант грамматики, в котором есть все граммемы required и нет
+    ни одной граммемы excluded. В отличие от gr_mask, граммемы проверяются
+    внутри одного варианта.
+
+    :param gr: строка с грамматикой
+    :param required: маска обязательных граммем
+    :param excluded: маска запрещённых граммем
+    """
+    for mask in gr_masks(gr):
+        if mask & required == required and not mask & excluded:
+            return True
+    return False
+
+
+def grammemes(mask):
+    """
+    Список граммем маски в порядке GRAMMEMES (обратно mask_of).
+    """
+    return [name for (_, names) in GRAMMEMES for name in names
+            if mask & BITS[name]]
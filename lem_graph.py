@@ -0,0 +1,233 @@
+#!/usr/bin/env python3.5
+# -*- coding: utf-8 -*-
+
+"""
+Компактное представление графа лемм. Леммы хранятся один раз и получают
+целочисленные номера, рёбра - упакованные в одно 64-битное число пары
+номеров, атрибуты узлов и веса рёбер - в типизированных массивах (array).
+По сравнению со словарями из lem.build_node_dict и lem.build_edge_dict
+это экономит память на больших графах.
+"""
+
+from array import array
+from bisect import bisect_left
+from collections import Counter
+from itertools import combinations
+
+
+class CompactGraph:
+    """
+    Граф лемм: узлы и рёбра с весами.
+
+    Пока граф строится (add_line), рёбра накапливаются в словаре
+    {упакованная пара: вес}. Метод pack переносит их в два отсортированных
+    массива (ключи и веса) и освобождает словарь; строки, добавленные после
+    этого, сливаются с массивами при следующем вызове pack. Функции
+    lem.write_node_dict и lem.write_edge_dict принимают граф вместо словарей.
+    """
+
+    def __init__(self):
+        # узлы
+        self.lexes = []  # номер леммы -> лемма
+        self.ids = {}  # лемма -> номер леммы
+        self.counts = array('q')  # номер леммы -> вес узла
+        self.bastard = array('b')  # номер леммы -> признак bastard
+        self.non_cyrillic = array('b')  # номер леммы -> признак non_cyrillic
+        # части речи: {(номер леммы << 8) | номер части речи: вес}
+        self.parts = {}
+        self.parts_names = []  # номер части речи -> часть речи
+        self.parts_ids = {}  # часть речи -> номер части речи
+        # рёбра
+        self.edges = {}  # {упакованная пара: вес} (пока граф строится)
+        self.edge_keys = array('Q')  # упакованные пары (после pack)
+        self.edge_weights = array('q')  # веса рёбер (после pack)
+
+    @staticmethod
+    def pack_pair(id_a, id_b):
+        return (id_a << 32) | id_b
+
+    @staticmethod
+    def unpack_pair(key):
+        return key >> 32, key & 0xFFFFFFFF
+
+    def intern(self, word):
+        """
+        Возвращает номер леммы, при необходимости добавляя новый узел.
+
+        :param word: объект Word, возвращаемый функцией lem.line_words
+        """
+        lex = word.lex
+        lex_id = self.ids.get(lex)
+        if lex_id is None:
+            lex_id = len(self.lexes)
+            self.ids[lex] = lex_id
+            self.lexes.append(lex)
+            self.counts.append(0)
+            self.bastard.append(word.bastard)
+            self.non_cyrillic.append(word.non_cyrillic)
+        return lex_id
+
+    def part_id(self, part_speech):
+        part_id = self.parts_ids.get(part_speech)
+        if part_id is None:
+            part_id = len(self.parts_names)
+            self.parts_ids[part_speech] = part_id
+            self.parts_names.append(part_speech)
+        return part_id
+
+    def add_line(self, words, weight, edges=True):
+        """
+        Добавляет в граф леммы одной строки (аналог lem.add_nodes и
+        lem.add_edges).
+
+        :param words: output функции lem.line_words
+        :param weight: вес строки (int)
+        :param edges: добавлять ли рёбра
+        :return: множество уникальных лемм строки
+        """
+        lexs_unique = set()
+        for word in words:
+            lex = word.lex
+            if lex in lexs_unique:
+                continue
+            lex_id = self.intern(word)
+            self.counts[lex_id] += weight
+            key = (lex_id << 8) | self.part_id(word.part_speech)
+            self.parts[key] = self.parts.get(key, 0) + weight
+            lexs_unique.add(lex)
+
+        if edges:
+            ids = [self.ids[lex] for lex in sorted(lexs_unique)]
+            graph_edges = self.edges
+            for (id_a, id_b) in combinations(ids, 2):
+                key = (id_a << 32) | id_b
+                graph_edges[key] = graph_edges.get(key, 0) + weight
+
+        return lexs_unique
+
+    def pack(self):
+        """
+        Переносит рёбра из словаря в отсортированные массивы.
+        """
+        if not self.edges:
+            return
+        # сливаем с уже упакованными рёбрами (если pack вызывается повторно)
+        for key, weight in zip(self.edge_keys, self.edge_weights):
+            self.edges[key] = self.edges.get(key, 0) + weight
+        keys = sorted(self.edges)
+        self.edge_keys = array('Q', keys)
+        del keys
+        self.edge_weights = array('q', (self.edges[key]
+                                        for key in self.edge_keys))
+        self.edges = {}
+
+    def edge_weight(self, lex_a, lex_b):
+        """
+        Вес ребра между двумя леммами (0, если ребра нет).
+        """
+        if lex_a > lex_b:
+            (lex_a, lex_b) = (lex_b, lex_a)
+        if lex_a not in self.ids or lex_b not in self.ids:
+            return 0
+        key = self.pack_pair(self.ids[lex_a], self.ids[lex_b])
+        weight = self.edges.get(key, 0)
+        i = bisect_left(self.edge_keys, key)
+        if i < len(self.edge_keys) and self.edge_keys[i] == key:
+            weight += self.edge_weights[i]
+        return weight
+
+    def node_parts(self):
+        """
+        Части речи каждого узла через запятую в порядке убывания веса
+        (аналог lem.part_speech_conflict_resolution).
+
+        :return: список: номер леммы -> строка частей речи
+        """
+        parts = [Counter() for _ in self.lexes]
+        for key, count in self.parts.items():
+            parts[key >> 8][key & 0xFF] = count
+        names = []
+        for counter in parts:
+            names.append(','.join(
+                self.parts_names[part_id] or 'None'
+                for part_id, _ in counter.most_common()))
+        return names
+
+    def node_rows(self, cut=0):
+        """
+        Строки узлов, отсортированные по убыванию веса, затем по лемме.
+
+        :param cut: не возвращать узлы с весом меньше, чем cut
+        :return: генератор кортежей (лемма, вес, части речи, bastard,
+        non_cyrillic)
+        """
+        parts = self.node_parts()
+        order = sorted((lex_id for lex_id in range(len(self.lexes))
+                        if self.counts[lex_id] >= cut),
+                       key=lambda i: (-self.counts[i], self.lexes[i]))
+        for lex_id in order:
+            yield (self.lexes[lex_id], self.counts[lex_id], parts[lex_id],
+                   bool(self.bastard[lex_id]),
+                   bool(self.non_cyrillic[lex_id]))
+
+    def edge_items(self):
+        """
+        Генератор рёбер вида ((лемма1, лемма2), вес) без сортировки.
+        """
+        self.pack()
+        lexes = self.lexes
+        for key, weight in zip(self.edge_keys, self.edge_weights):
+            yield (lexes[key >> 32], lexes[key & 0xFFFFFFFF]), weight
+
+    def edge_rows(self, cut=0):
+        """
+        Рёбра, отсортированные по убыванию веса, затем по паре лемм.
+        Вместо кортежей сортируются целые числа, в которые упакованы вес
+        и места лемм в алфавитном порядке.
+
+        :param cut: не возвращать рёбра с весом меньше, чем cut
+        :return: генератор кортежей (лемма1, лемма2, вес)
+        """
+        self.pack()
+        if not self.edge_weights:
+            return
+        # место каждой леммы в алфавитном порядке
+        by_rank = sorted(range(len(self.lexes)), key=self.lexes.__getitem__)
+        rank = array('q', [0]) * len(self.lexes)
+        for place, lex_id in enumerate(by_rank):
+            rank[lex_id] = place
+
+        top = max(self.edge_weights)
+        order = sorted(
+            ((top - weight) << 64) | (rank[key >> 32] << 32) |
+            rank[key & 0xFFFFFFFF]
+            for key, weight in zip(self.edge_keys, self.edge_weights)
+            if weight >= cut)
+        for item in order:
+            yield (self.lexes[by_rank[(item >> 32) & 0xFFFFFFFF]],
+                   self.lexes[by_rank[item & 0xFFFFFFFF]],
+                   top - (item >> 64))
+
+    def to_node_dict(self):
+        """
+        Словарь узлов в формате lem.build_node_dict.
+        """
+        node_dict = {}
+        for lex_id, lex in enumerate(self.lexes):
+            node_dict[lex] = {
+                'lex': lex,
+                'part_speech': Counter(),
+                'bastard': bool(self.bastard[lex_id]),
+                'non_cyrillic': bool(self.non_cyrillic[lex_id]),
+                'count': self.counts[lex_id],
+            }
+        for key, count in self.parts.items():
+            lex = self.lexes[key >> 8]
+            node_dict[lex]['part_speech'][self.parts_names[key & 0xFF]] = count
+        return node_dict
+
+    def to_edge_dict(self):
+        """
+        Счётчик рёбер в формате lem.build_edge_dict.
+        """
+        return Counter(dict(self.edge_items()))
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3.5
+# -*- coding: utf-8 -*-
+
+"""
+Приближённый подсчёт самых тяжёлых рёбер в ограниченной памяти.
+Используется алгоритм Misra-Gries (Frequent) с пакетным вычитанием - двойник
+алгоритма Space-Saving с теми же гарантиями точности.
+"""
+
+import heapq
+from collections import Counter
+
+
+class HeavyEdgeCounter(Counter):
+    """
+    Счётчик рёбер, хранящий не больше 2 * capacity записей.
+
+    Когда записей становится больше, из всех весов вычитается
+    (capacity + 1)-й по величине вес, и неположительные записи удаляются.
+    Поэтому:
+    - хранимый вес ребра - нижняя оценка истинного веса;
+    - истинный вес не больше хранимого веса + error;
+    - error <= total / (capacity + 1), где total - суммарный вес всех пар;
+    - любое ребро с истинным весом больше error гарантированно сохранено.
+    Пока вычитаний не было (error == 0), подсчёт точный.
+
+    Счётчик можно передавать в lem.write_edge_dict, как обычный Counter.
+    """
+
+    def __init__(self, capacity):
+        """
+        :param capacity: бюджет памяти (количество гарантированно хранимых
+        рёбер)
+        """
+        super().__init__()
+        self.capacity = capacity
+        self.error = 0  # суммарное вычтенное значение
+        self.total = 0  # суммарный вес всех добавленных пар
+
+    def copy(self):
+        counter = HeavyEdgeCounter(self.capacity)
+        dict.update(counter, self)
+        counter.error = self.error
+        counter.total = self.total
+        return counter
+
+    def __reduce__(self):
+        return self.__class__, (self.capacity,), self.__dict__, None, \
+            iter(self.items())
+
+    def add_pairs(self, pairs, weight):
+        """
+        Добавляет пары одной строки и при необходимости сжимает счётчик.
+
+        :param pairs: итерируемый набор пар лемм
+        :param weight: вес строки (int)
+        """
+        count = 0
+        for pair in pairs:
+            self[pair] += weight
+            count += 1
+        self.total += count * weight
+        if len(self) > 2 * self.capacity:
+            self.shrink()
+
+    def shrink(self):
+        """
+        Оставляет не больше capacity записей (пакетное вычитание).
+        """
+        if len(self) <= self.capacity:
+            return
+        decrement = heapq.nlargest(self.capacity + 1, self.values())[-1]
+        kept = {pair: count - decrement for pair, count in self.items()
+                if count > decrement}
+        self.clear()
+        dict.update(self, kept)
+        self.error += decrement
+
+    def bounds(self, pair):
+        """
+        Границы истинного веса ребра.
+
+        :return: кортеж (нижняя граница, верхняя граница)
+        """
+        count = self.get(pair, 0)
+        return count, count + self.error
+
+    def heavy(self, cut):
+        """
+        Рёбра, истинный вес которых не меньше cut.
+
+        :param cut: порог веса
+        :return: кортеж из двух словарей {ребро: нижняя граница}: рёбра,
+        вес которых гарантированно не меньше cut, и рёбра, вес которых
+        может быть не меньше cut
+        """
+        sure = {}
+        maybe = {}
+        for pair, count in self.items():
+            if count >= cut:
+                sure[pair] = count
+            elif count + self.error >= cut:
+                maybe[pair] = count
+        return sure, maybe
+
+    def stats(self):
+        """
+        Статистика и оценка погрешности.
+
+        :return: словарь вида {'capacity': int, 'size': int, 'total': int,
+        'error': int, 'error_bound': float}, где error_bound - теоретическая
+        граница погрешности total / (capacity + 1)
+        """
+        return {'capacity': self.capacity, 'size': len(self),
+                'total': self.total, 'error': self.error,
+                'error_bound': self.total / (self.capacity + 1)}
@@ -0,0 +1,249 @@
+#!/usr/bin/env python3.5
+# -*- coding: utf-8 -*-
+
+"""
+Замеры этапов make_gephi_files: время, количество строк и пар в секунду,
+память (RSS в начале и в конце этапа, пиковая RSS процесса и Mystem с начала
+работы, по желанию - пик tracemalloc). Итог
+сохраняется в json-отчёт, а во время длинных этапов можно получать события
+о ходе работы с оценкой оставшегося времени.
+
+Без Recorder замеры не ведутся: в функции передаётся stage=None, и вся
+стоимость - одна проверка на строку.
+"""
+
+import os
+import sys
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+from common_functions import pretty_json
+
+# Через сколько строк проверять, не пора ли отправить событие о ходе работы
+CHECK_EVERY = 1000
+
+
+def peak_rss():
+    """
+    Пиковая память (RSS) текущего процесса и его дочерних процессов (Mystem)
+    в килобайтах или (None, None), если модуль resource недоступен.
+    """
+    if resource is None:
+        return None, None
+    scale = 1024 if sys.platform == 'darwin' else 1  # на macOS - в байтах
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // scale,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss // scale)
+
+
+def current_rss():
+    """
+    Текущая память (RSS) процесса в килобайтах по /proc/self/statm или None,
+    если он недоступен (не Linux).
+    """
+    try:
+        with open('/proc/self/statm', 'r') as file_r:
+            pages = int(file_r.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+    return pages * (os.sysconf('SC_PAGE_SIZE') // 1024)
+
+
+def print_event(event):
+    """
+    Вывод события о ходе работы в stderr (пример обработчика on_event).
+    """
+    if event['event'] == 'progress':
+        eta = event['eta']
+        print('%s: %d lines, %.0f lines/s, ETA %s' % (
+            event['stage'], event['lines'], event['lines_per_sec'],
+            '?' if eta is None else '%.0f s' % eta), file=sys.stderr)
+    else:
+        print('%s: %s' % (event['stage'], event['event']), file=sys.stderr)
+
+
+class Stage:
+    """
+    Замер одного этапа (см. Recorder.stage).
+    """
+
+    def __init__(self, recorder, name, total=None):
+        """
+        :param recorder: Recorder, которому принадлежит этап
+        :param name: название этапа
+        :param total: ожидаемое количество строк (для оценки оставшегося
+        времени), если известно
+        """
+        self.recorder = recorder
+        self.name = name
+        self.total = total
+        self.lines = 0
+        self.pairs = 0
+        self.parts = {}  # время частей этапа, сек
+        self.started = time.monotonic()
+        self.last_event = self.started
+        self.rss_start = current_rss()
+        self.next_check = recorder.check_every
+
+    def add(self, lines=1, pairs=0):
+        """
+        Учитывает обработанные строки и пары лемм.
+        """
+        self.lines += lines
+        self.pairs += pairs
+        if self.lines >= self.next_check and self.recorder.on_event:
+            self.next_check = self.lines + self.recorder.check_every
+            now = time.monotonic()
+            if now - self.last_event >= self.recorder.interval:
+                self.last_event = now
+                self.recorder.emit(self.progress(now))
+
+    def part(self, name, seconds):
+        """
+        Добавляет время части этапа (например, разбора json внутри подсчёта
+        узлов и рёбер).
+        """
+        self.parts[name] = self.parts.get(name, 0) + seconds
+
+    def progress(self, now):
+        elapsed = now - self.started
+        rate = self.lines / elapsed if elapsed > 0 else 0
+        eta = None
+        if self.total and rate:
+            eta = max(self.total - self.lines, 0) / rate
+        return {'event': 'progress', 'stage': self.name, 'lines': self.lines,
+                'pairs': self.pairs, 'total': self.total,
+                'elapsed': elapsed, 'lines_per_sec': rate, 'eta': eta}
+
+    def result(self, now):
+        """
+        Итог этапа для отчёта.
+        """
+        elapsed = now - self.started
+        result = {
+            'name': self.name, 'time': elapsed, 'lines': self.lines,
+            'pairs': self.pairs,
+            'lines_per_sec': self.lines / elapsed if elapsed > 0 else None,
+            'pairs_per_sec': self.pairs / elapsed if elapsed > 0 else None}
+        if self.parts:
+            result['parts'] = dict(self.parts)
+        # ru_maxrss - пик за всё время работы процесса, а не этапа
+        (result['process_peak_rss_kb_so_far'],
+         result['children_peak_rss_kb_so_far']) = peak_rss()
+        rss_end = current_rss()
+        result['rss_start_kb'] = self.rss_start
+        result['rss_end_kb'] = rss_end
+        result['rss_delta_kb'] = None
+        if self.rss_start is not None and rss_end is not None:
+            result['rss_delta_kb'] = rss_end - self.rss_start
+        if self.recorder.trace_memory:
+            peak = tracemalloc.get_traced_memory()[1]
+            result['peak_traced_kb'] = peak // 1024
+        return result
+
+
+class Recorder:
+    """
+    Замеры этапов работы и json-отчёт о запуске.
+
+    Пример:
+        recorder = Recorder(on_event=print_event, interval=60)
+        lem.make_gephi_files(..., recorder=recorder)
+        recorder.write_report('output/report.json')
+    """
+
+    def __init__(self, on_event=None, interval=10.0, check_every=CHECK_EVERY,
+                 trace_memory=False):
+        """
+        :param on_event: функция, которая получает события (словари) о начале
+        и конце этапов и о ходе работы (по умолчанию события не отправляются)
+        :param interval: не чаще, чем раз в сколько секунд отправлять событие
+        о ходе работы одного этапа
+        :param check_every: через сколько строк проверять время
+        :param trace_memory: замерять пиковую память Python через tracemalloc
+        (заметно замедляет работу). На Python до 3.9 пик считается от начала
+        замеров, а не от начала этапа
+        """
+        self.on_event = on_event
+        self.interval = interval
+        self.check_every = check_every
+        self.trace_memory = trace_memory
+        self.started = time.monotonic()
+        self.stages = []
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def emit(self, event):
+        if self.on_event:
+            self.on_event(event)
+
+    def stage(self, name, total=None):
+        """
+        Замер этапа: with recorder.stage('mystem') as stage: ...
+
+        :param name: название этапа
+        :param total: ожидаемое количество строк, если известно
+        :return: менеджер контекста, который возвращает Stage
+        """
+        return StageContext(self, name, total)
+
+    def report(self):
+        """
+        Отчёт о запуске: этапы в порядке выполнения и общее время.
+        """
+        (rss, children_rss) = peak_rss()
+        return {'time': time.monotonic() - self.started,
+                'stages': self.stages, 'peak_rss_kb': rss,
+                'peak_children_rss_kb': children_rss}
+
+    def write_report(self, file_name):
+        """
+        Записывает отчёт (см. report) в json-файл.
+        """
+        with open(file_name, 'w') as file_w:
+            pretty_json(self.report(), file_w)
+
+
+class StageContext:
+    def __init__(self, recorder, name, total):
+        self.recorder = recorder
+        self.name = name
+        self.total = total
+        self.stage = None
+
+    def __enter__(self):
+        if self.recorder.trace_memory and hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        self.stage = Stage(self.recorder, self.name, self.total)
+        self.recorder.emit({'event': 'start', 'stage': self.name})
+        return self.stage
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        result = self.stage.result(time.monotonic())
+        self.recorder.stages.append(result)
+        self.recorder.emit({'event': 'finish', 'stage': self.name,
+                            'result': result})
+
+
+class NullRecorder:
+    """
+    Recorder без замеров: stage возвращает None.
+    """
+
+    def stage(self, name, total=None):
+        return NULL_STAGE
+
+
+class NullStageContext:
+    def __enter__(self):
+        return None
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+NULL_STAGE = NullStageContext()
@@ -0,0 +1,289 @@
+#!/usr/bin/env python3.5
+# -*- coding: utf-8 -*-
+
+"""
+Компактный двоичный снимок графа лемм (узлы и рёбра с весами) и чтение его
+через mmap. Открытие снимка не требует разбора: массивы используются прямо
+из отображённого в память файла, поиск леммы и веса ребра - двоичный поиск.
+
+Формат файла (все секции выровнены на 8 байт, массивы - в порядке байтов
+записавшей машины, он указан в заголовке):
+    заголовок: MAGIC, порядок байтов (1 - little, 2 - big), количество узлов,
+        количество рёбер, смещения секций
+    lex_offsets: (n + 1) x uint64 - границы лемм в lex_blob
+    lex_blob: леммы в utf-8, отсортированы по возрастанию
+    parts_offsets: (n + 1) x uint64 - границы строк частей речи в parts_blob
+    parts_blob: части речи каждого узла через запятую в порядке убывания веса
+    counts: n x int64 - веса узлов
+    flags: n x uint8 - бит 0: bastard, бит 1: non_cyrillic
+    edge_keys: m x uint64 - пары номеров лемм (номер1 << 32 | номер2),
+        отсортированы по возрастанию
+    edge_weights: m x int64 - веса рёбер
+"""
+
+import mmap
+import shutil
+import struct
+import sys
+import tempfile
+from array import array
+from bisect import bisect_left
+
+from lem_spill import SpillCounter
+
+MAGIC = b'LEMSNAP1'
+# MAGIC, порядок байтов, узлы, рёбра и смещения 8 секций
+HEADER = struct.Struct('<8sQQQ8Q')
+SECTIONS = ('lex_offsets', 'lex_blob', 'parts_offsets', 'parts_blob',
+            'counts', 'flags', 'edge_keys', 'edge_weights')
+BYTEORDER = {'little': 1, 'big': 2}
+
+
+def node_parts(part_speech):
+    """
+    Части речи узла через запятую в порядке убывания веса (как в
+    lem.part_speech_conflict_resolution).
+    """
+    return ','.join(part or 'None' for part, _ in part_speech.most_common())
+
+
+def write_snapshot(file_name, node_dict, edge_dict):
+    """
+    Записывает словари узлов и рёбер в двоичный снимок. Рёбра SpillCounter
+    уже отсортированы по парам лемм, поэтому они записываются по мере
+    слияния серий и целиком в памяти не собираются. Рёбра остальных
+    счётчиков сортируются в памяти.
+
+    :param file_name: имя файла снимка
+    :param node_dict: словарь узлов (см. lem.build_node_dict)
+    :param edge_dict: счётчик рёбер (см. lem.build_edge_dict; подходят
+    и HeavyEdgeCounter, и SpillCounter)
+    :raise ValueError: если рёбра SpillCounter идут не по порядку пар лемм
+    (пара должна быть упорядочена: лемма1 < лемма2)
+    """
+    lexes = sorted(node_dict)
+    ids = {lex: lex_id for lex_id, lex in enumerate(lexes)}
+
+    sections = {}
+    (sections['lex_offsets'], sections['lex_blob']) = pack_strings(lexes)
+    (sections['parts_offsets'], sections['parts_blob']) = pack_strings(
+        node_parts(node_dict[lex]['part_speech']) for lex in lexes)
+    sections['counts'] = array('q', (node_dict[lex]['count']
+                                     for lex in lexes)).tobytes()
+    sections['flags'] = bytes(
+        int(bool(node_dict[lex]['bastard'])) |
+        int(bool(node_dict[lex]['non_cyrillic'])) << 1 for lex in lexes)
+
+    edges = (((ids[lex_a] << 32) | ids[lex_b], weight)
+             for (lex_a, lex_b), weight in edge_dict.items())
+    if not isinstance(edge_dict, SpillCounter):
+        edges = sorted(edges)
+
+    with open(file_name, 'wb') as file_w, \
+            tempfile.TemporaryFile() as file_weights:
+        # заголовок записывается в конце, когда известно количество рёбер
+        file_w.write(b'\0' * HEADER.size)
+        offsets = []
+        for name in SECTIONS[:-2]:
+            offsets.append(file_w.tell())
+            write_padded(file_w, sections[name])
+
+        # ключи рёбер пишутся сразу в снимок, веса - во временный файл,
+        # который потом дописывается следующей секцией
+        offsets.append(file_w.tell())
+        edge_count = 0
+        for (keys, weights) in edge_chunks(edges):
+            file_w.write(keys.tobytes())
+            file_weights.write(weights.tobytes())
+            edge_count += len(keys)
+        offsets.append(file_w.tell())
+        file_weights.seek(0)
+        shutil.copyfileobj(file_weights, file_w)
+
+        file_w.seek(0)
+        file_w.write(HEADER.pack(MAGIC, BYTEORDER[sys.byteorder], len(lexes),
+                                 edge_count, *offsets))
+
+
+def edge_chunks(edges, size=65536):
+    """
+    Делит отсортированные рёбра на массивы ключей и весов по size рёбер.
+
+    :param edges: итерируемый набор вида (ключ ребра, вес) по возрастанию
+    ключей
+    :return: генератор кортежей (array('Q') ключей, array('q') весов)
+    :raise ValueError: если ключи идут не по возрастанию или пара лемм не
+    упорядочена
+    """
+    keys = array('Q')
+    weights = array('q')
+    last = -1
+    for (key, weight) in edges:
+        if key <= last or key >> 32 >= key & 0xFFFFFFFF:
+            raise ValueError('Edges are not sorted by lemma pair')
+        last = key
+        keys.append(key)
+        weights.append(weight)
+        if len(keys) >= size:
+            yield keys, weights
+            keys = array('Q')
+            weights = array('q')
+    if keys:
+        yield keys, weights
+
+
+def padded(size):
+    return (size + 7) // 8 * 8
+
+
+def write_padded(file_w, data):
+    """
+    Записывает секцию с нулями до границы 8 байт.
+    """
+    file_w.write(data)
+    file_w.write(b'\0' * (padded(len(data)) - len(data)))
+
+
+def pack_strings(strings):
+    """
+    Упаковывает строки в массив границ и общий блок байтов.
+
+    :return: кортеж (границы в байтах, блок в байтах)
+    """
+    offsets = array('Q', [0])
+    blob = bytearray()
+    for string in strings:
+        blob += string.encode('utf-8')
+        offsets.append(len(blob))
+    return offsets.tobytes(), bytes(blob)
+
+
+class Snapshot:
+    """
+    Снимок графа, открытый через mmap (см. write_snapshot). Открытие
+    занимает O(1): файл не читается целиком и не разбирается.
+
+    Пример:
+        with Snapshot('output/graph.bin') as graph:
+            graph.edge_weight('купить', 'слон')
+    """
+
+    def __init__(self, file_name):
+        """
+        :param file_name: имя файла снимка
+        """
+        with open(file_name, 'rb') as file_r:
+            self.data = mmap.mmap(file_r.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, byteorder, self.node_count, self.edge_count,
+         *offsets) = HEADER.unpack_from(self.data)
+        if magic != MAGIC:
+            self.data.close()
+            raise ValueError('Not a graph snapshot: %s' % file_name)
+        if byteorder != BYTEORDER[sys.byteorder]:
+            self.data.close()
+            raise ValueError('Snapshot byte order differs from this machine')
+
+        self.view = view = memoryview(self.data)
+        sizes = {'lex_offsets': (self.node_count + 1) * 8,
+                 'parts_offsets': (self.node_count + 1) * 8,
+                 'counts': self.node_count * 8,
+                 'flags': self.node_count,
+                 'edge_keys': self.edge_count * 8,
+                 'edge_weights': self.edge_count * 8}
+        sections = dict(zip(SECTIONS, offsets))
+        formats = {'lex_offsets': 'Q', 'parts_offsets': 'Q', 'counts': 'q',
+                   'flags': 'B', 'edge_keys': 'Q', 'edge_weights': 'q'}
+        for name, fmt in formats.items():
+            start = sections[name]
+            setattr(self, name, view[start:start + sizes[name]].cast(fmt))
+        self.lex_blob = sections['lex_blob']
+        self.parts_blob = sections['parts_blob']
+
+    def lex(self, lex_id):
+        """
+        Лемма по номеру.
+        """
+        return self.data[self.lex_blob + self.lex_offsets[lex_id]:
+                         self.lex_blob + self.lex_offsets[lex_id + 1]
+                         ].decode('utf-8')
+
+    def find(self, lex):
+        """
+        Номер леммы (двоичный поиск) или None, если леммы нет.
+        """
+        key = lex.encode('utf-8')
+        (low, high) = (0, self.node_count)
+        while low < high:
+            middle = (low + high) // 2
+            value = self.data[self.lex_blob + self.lex_offsets[middle]:
+                              self.lex_blob + self.lex_offsets[middle + 1]]
+            # порядок байтов utf-8 совпадает с порядком строк
+            if value < key:
+                low = middle + 1
+            elif value > key:
+                high = middle
+            else:
+                return middle
+        return None
+
+    def node(self, lex):
+        """
+        Атрибуты узла или None, если узла нет.
+
+        :return: словарь вида {'lex': str, 'count': int, 'parts': str,
+        'bastard': bool, 'non_cyrillic': bool}
+        """
+        lex_id = self.find(lex)
+        if lex_id is None:
+            return None
+        return self.node_info(lex_id)
+
+    def node_info(self, lex_id):
+        flags = self.flags[lex_id]
+        parts = self.data[self.parts_blob + self.parts_offsets[lex_id]:
+                          self.parts_blob + self.parts_offsets[lex_id + 1]]
+        return {'lex': self.lex(lex_id), 'count': self.counts[lex_id],
+                'parts': parts.decode('utf-8'), 'bastard': bool(flags & 1),
+                'non_cyrillic': bool(flags & 2)}
+
+    def edge_weight(self, lex_a, lex_b):
+        """
+        Вес ребра между двумя леммами (0, если ребра нет).
+        """
+        if lex_a > lex_b:
+            (lex_a, lex_b) = (lex_b, lex_a)
+        (id_a, id_b) = (self.find(lex_a), self.find(lex_b))
+        if id_a is None or id_b is None:
+            return 0
+        key = (id_a << 32) | id_b
+        i = bisect_left(self.edge_keys, key)
+        if i < self.edge_count and self.edge_keys[i] == key:
+            return self.edge_weights[i]
+        return 0
+
+    def nodes(self):
+        """
+        Генератор атрибутов всех узлов (см. node) в порядке лемм.
+        """
+        for lex_id in range(self.node_count):
+            yield self.node_info(lex_id)
+
+    def edges(self):
+        """
+        Генератор рёбер вида ((лемма1, лемма2), вес) в порядке пар лемм.
+        """
+        for key, weight in zip(self.edge_keys, self.edge_weights):
+            yield (self.lex(key >> 32), self.lex(key & 0xFFFFFFFF)), weight
+
+    def close(self):
+        for name in ('lex_offsets', 'parts_offsets', 'counts', 'flags',
+                     'edge_keys', 'edge_weights'):
+            getattr(self, name).release()
+        self.view.release()
+        self.data.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
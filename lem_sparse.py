@@ -0,0 +1,106 @@
+#!/usr/bin/env python3.5
+# -*- coding: utf-8 -*-
+
+"""
+Подсчёт рёбер через разреженные матрицы. Если A - матрица инцидентности
+"строка x лемма" (1, если лемма есть в строке), а w - веса строк, то веса
+рёбер - это элементы над главной диагональю матрицы Aᵀ·diag(w)·A. Матрица
+A собирается в формате CSR, а произведение считается одной векторной
+операцией scipy вместо цикла по парам на Python.
+
+Требует numpy и scipy (необязательные зависимости).
+"""
+
+from array import array
+from collections import Counter
+
+try:
+    import numpy
+    from scipy import sparse
+except ImportError:
+    numpy = None
+    sparse = None
+
+
+class IncidenceBuilder:
+    """
+    Построчная сборка матрицы инцидентности в массивах CSR (indptr, indices)
+    и весов строк.
+
+    Пример:
+        builder = IncidenceBuilder()
+        for lems, weight in lines:
+            builder.add_line(lems, weight)
+        edge_dict = builder.cooccurrence(cut=3)
+    """
+
+    def __init__(self):
+        if sparse is None:
+            raise ImportError('IncidenceBuilder requires numpy and scipy')
+        self.lexes = []  # номер столбца -> лемма
+        self.ids = {}  # лемма -> номер столбца
+        self.indptr = array('q', [0])  # границы строк в indices
+        self.indices = array('q')  # номера столбцов (лемм) по строкам
+        self.weights = array('q')  # веса строк
+
+    def add_line(self, lems, weight):
+        """
+        Добавляет строку матрицы.
+
+        :param lems: множество уникальных лемм строки
+        :param weight: вес строки (int)
+        """
+        ids = self.ids
+        indices = self.indices
+        for lex in lems:
+            lex_id = ids.get(lex)
+            if lex_id is None:
+                lex_id = len(self.lexes)
+                ids[lex] = lex_id
+                self.lexes.append(lex)
+            indices.append(lex_id)
+        self.indptr.append(len(indices))
+        self.weights.append(weight)
+
+    def matrix(self):
+        """
+        Матрица инцидентности, столбцы которой упорядочены по леммам (так
+        пары из верхнего треугольника сразу получаются отсортированными).
+
+        :return: кортеж (матрица scipy.sparse.csr_matrix, список лемм по
+        номерам столбцов)
+        """
+        order = sorted(range(len(self.lexes)), key=self.lexes.__getitem__)
+        rank = numpy.empty(len(order), dtype=numpy.int64)
+        rank[order] = numpy.arange(len(order), dtype=numpy.int64)
+        indices = rank[numpy.frombuffer(self.indices, dtype=numpy.int64)]
+        indptr = numpy.frombuffer(self.indptr, dtype=numpy.int64)
+        data = numpy.ones(len(indices), dtype=numpy.int64)
+        shape = (len(self.weights), len(order))
+        matrix = sparse.csr_matrix((data, indices, indptr), shape=shape)
+        return matrix, [self.lexes[lex_id] for lex_id in order]
+
+    def cooccurrence(self, cut=0):
+        """
+        Веса рёбер: верхний треугольник Aᵀ·diag(w)·A. Рёбра с весом меньше
+        cut отбрасываются до перевода в объекты Python.
+
+        :param cut: минимальный вес ребра
+        :return: Counter вида {(лемма1, лемма2): вес}, как у
+        lem.build_edge_dict
+        """
+        if not self.indices:
+            return Counter()
+        (matrix, lexes) = self.matrix()
+        weights = numpy.frombuffer(self.weights, dtype=numpy.int64)
+        # строки A, умноженные на свои веса: diag(w)·A
+        weighted = sparse.csr_matrix(
+            (numpy.repeat(weights, numpy.diff(matrix.indptr)),
+             matrix.indices, matrix.indptr), shape=matrix.shape)
+        product = sparse.triu(matrix.T.tocsr() @ weighted, k=1).tocoo()
+        keep = product.data >= max(cut, 1)
+        rows = product.row[keep].tolist()
+        cols = product.col[keep].tolist()
+        counts = product.data[keep].tolist()
+        return Counter({(lexes[row], lexes[col]): count
+                        for row, col, count in zip(rows, cols, counts)})
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3.5
+# -*- coding: utf-8 -*-
+
+"""
+Подсчёт и сортировка рёбер с выгрузкой на диск, когда граф не помещается
+в оперативную память. Частичные счётчики сбрасываются в отсортированные
+временные файлы (серии), которые затем сливаются k-путевым слиянием.
+
+В файлах серий поля разделяются табуляцией: леммы Mystem не содержат
+пробельных символов.
+"""
+
+import heapq
+import os
+import shutil
+import tempfile
+from collections import Counter
+from itertools import groupby
+from itertools import islice
+
+# Сколько серий сливать за один раз (ограничивает число открытых файлов)
+MAX_FANIN = 64
+
+
+def write_run(items, file_name):
+    """
+    Записывает серию рёбер в файл.
+
+    :param items: итерируемый набор вида ((лемма1, лемма2), вес)
+    :param file_name: имя файла
+    """
+    with open(file_name, 'w', encoding='utf-8') as file_w:
+        for (lex_a, lex_b), count in items:
+            file_w.write('%s\t%s\t%d\n' % (lex_a, lex_b, count))
+
+
+def read_run(file_name):
+    """
+    Генератор рёбер вида ((лемма1, лемма2), вес) из файла серии.
+    """
+    with open(file_name, 'r', encoding='utf-8') as file_r:
+        for line in file_r:
+            (lex_a, lex_b, count) = line.rstrip('\n').split('\t')
+            yield (lex_a, lex_b), int(count)
+
+
+def compact_runs(runs, tmp_dir, key=None, combine=False):
+    """
+    Если серий больше, чем MAX_FANIN, то сливает их группами
+    в промежуточные серии (исходные файлы удаляются), пока их не станет
+    не больше MAX_FANIN.
+
+    :param runs: список имён файлов серий
+    :param tmp_dir: папка для промежуточных серий
+    :param key: ключ сортировки серий (как в sorted)
+    :param combine: суммировать ли веса одинаковых рёбер (см. sum_sorted)
+    :return: новый список имён файлов серий
+    """
+    runs = list(runs)
+    while len(runs) > MAX_FANIN:
+        merged = []
+        for start in range(0, len(runs), MAX_FANIN):
+            group = runs[start:start + MAX_FANIN]
+            (fd, file_name) = tempfile.mkstemp(suffix='.run', dir=tmp_dir)
+            os.close(fd)
+            items = heapq.merge(*map(read_run, group), key=key)
+            if combine:
+                items = sum_sorted(items)
+            write_run(items, file_name)
+            for name in group:
+                os.remove(name)
+            merged.append(file_name)
+        runs = merged
+    return runs
+
+
+def merge_runs(runs, key=None):
+    """
+    Генератор k-путевого слияния отсортированных серий.
+
+    :param runs: список имён файлов серий (см. compact_runs)
+    :param key: ключ сортировки серий (как в sorted)
+    """
+    return heapq.merge(*map(read_run, runs), key=key)
+
+
+def sum_sorted(items):
+    """
+    Суммирует веса подряд идущих одинаковых рёбер (вход отсортирован
+    по рёбрам).
+    """
+    for pair, group in groupby(items, key=lambda item: item[0]):
+        yield pair, sum(count for _, count in group)
+
+
+class SpillCounter:
+    """
+    Счётчик рёбер, который держит в памяти не больше max_items рёбер.
+    Когда память заполняется, рёбра сортируются и сбрасываются во временный
+    файл. Метод items сливает все серии и возвращает рёбра в порядке
+    сортировки пар с суммарными весами.
+
+    Счётчик можно передавать в lem.write_edge_dict: сортировка по весу тоже
+    выполняется с выгрузкой на диск (см. sort_by_weight).
+    """
+
+    def __init__(self, max_items=1000000, tmp_dir=None):
+        """
+        :param max_items: сколько рёбер держать в памяти
+        :param tmp_dir: папка для временных файлов (по умолчанию системная)
+        """
+        self.max_items = max_items
+        self.counter = Counter()
+        self.runs = []
+        self.tmp_dir = tempfile.mkdtemp(prefix='lem_spill_', dir=tmp_dir)
+
+    def add_pairs(self, pairs, weight):
+        """
+        Добавляет пары одной строки и при необходимости сбрасывает счётчик
+        на диск.
+
+        :param pairs: итерируемый набор пар лемм
+        :param weight: вес строки (int)
+        """
+        counter = self.counter
+        for pair in pairs:
+            counter[pair] += weight
+        if len(counter) >= self.max_items:
+            self.spill()
+
+    def spill(self):
+        """
+        Сбрасывает рёбра из памяти в новую отсортированную серию.
+        """
+        if not self.counter:
+            return
+        (fd, file_name) = tempfile.mkstemp(suffix='.run', dir=self.tmp_dir)
+        os.close(fd)
+        write_run(sorted(self.counter.items()), file_name)
+        self.runs.append(file_name)
+        self.counter = Counter()
+
+    def items(self):
+        """
+        Генератор всех рёбер вида ((лемма1, лемма2), вес) в порядке
+        сортировки пар.
+        """
+        if not self.runs:
+            return iter(sorted(self.counter.items()))
+        self.spill()
+        self.runs = compact_runs(self.runs, self.tmp_dir, combine=True)
+        return sum_sorted(merge_runs(self.runs))
+
+    def close(self):
+        """
+        Удаляет временные файлы.
+        """
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+        self.runs = []
+        self.counter = Counter()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def sort_by_weight(items, max_items=1000000, tmp_dir=None):
+    """
+    Внешняя сортировка рёбер по убыванию веса, затем по паре лемм.
+    В памяти одновременно находится не больше max_items рёбер.
+
+    :param items: итерируемый набор вида ((лемма1, лемма2), вес)
+    :param max_items: размер сортируемой в памяти порции
+    :param tmp_dir: папка для временных файлов (по умолчанию системная)
+    :return: генератор рёбер в порядке сортировки
+    """
+    def key(item):
+        return -item[1], item[0]
+
+    items = iter(items)
+    chunk = sorted(islice(items, max_items), key=key)
+    if len(chunk) < max_items:
+        # всё поместилось в память
+        yield from chunk
+        return
+
+    tmp_dir = tempfile.mkdtemp(prefix='lem_sort_', dir=tmp_dir)
+    try:
+        runs = []
+        while chunk:
+            (fd, file_name) = tempfile.mkstemp(suffix='.run', dir=tmp_dir)
+            os.close(fd)
+            write_run(chunk, file_name)
+            runs.append(file_name)
+            chunk = sorted(islice(items, max_items), key=key)
+        runs = compact_runs(runs, tmp_dir, key=key)
+        yield from merge_runs(runs, key=key)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
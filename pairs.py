@@ -7,6 +7,34 @@
 """
 
 import sys
+from itertools import combinations
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Сколько пар накапливать перед записью в стандартный вывод (режим --tsv)
+CHUNK_SIZE = 10000
+
+
+def iter_pairs(elements, unique=False):
+    """
+    Генератор всех возможных пар объектов без повторов (в том же порядке,
+    что и pairs). Пары не хранятся в памяти.
+
+    :type elements: iterable object
+    :param elements: набор объектов
+    :param unique: флаг удаления повторяющихся объектов
+    :return: генератор отсортированных пар объектов
+    """
+    if unique:
+        elements = set(elements)
+
+    # Сортируем входной набор, чтобы пары всегда получались единообразно
+    # вне зависимости от входных данных. Наборы (1,2,3) и (3,2,1) будут
+    # на выходе давать одинаковые пары: (1,2), (1,3), (2,3)
+    return combinations(sorted(elements), 2)
 
 
 def pairs(elements, unique=False):
@@ -20,40 +48,76 @@ def pairs(elements, unique=False):
     :param unique: флаг удаления повторяющихся объектов
     :return: список отсортированных пар объектов
     """
+    return list(iter_pairs(elements, unique))
+
+
+def pairs_array(elements, unique=False):
+    """
+    Пары в виде массивов индексов NumPy (numpy.triu_indices): пара номер k -
+    это (objects[first[k]], objects[second[k]]). Порядок пар тот же, что
+    и у pairs. Требует установленного numpy.
+
+    :type elements: iterable object
+    :param elements: набор объектов
+    :param unique: флаг удаления повторяющихся объектов
+    :return: кортеж (отсортированный список объектов, массив индексов первых
+    объектов пар, массив индексов вторых объектов пар)
+    """
+    if numpy is None:
+        raise ImportError('pairs_array requires numpy')
     if unique:
         elements = set(elements)
+    objects = sorted(elements)
+    (first, second) = numpy.triu_indices(len(objects), k=1)
+    return objects, first, second
 
-    # Сортируем входной набор, чтобы пары всегда получались единообразно
-    # вне зависимости от входных данных. Наборы (1,2,3) и (3,2,1) будут
-    # на выходе давать одинаковые пары: (1,2), (1,3), (2,3)
-    elements = sorted(elements)
 
-    pairs_list = []
-    # удаляем по одному элементу пока в наборе не останется всего один
-    while len(elements) > 1:
-        first = elements.pop(0)
-        for el in elements:
-            pair = (first, el)
-            pairs_list.append(pair)
+def write_tsv(elements, unique=False, file_w=None, chunk_size=CHUNK_SIZE):
+    """
+    Записывает пары объектов построчно через табуляцию. Пары пишутся
+    порциями по chunk_size, весь список пар в памяти не хранится.
 
-    return pairs_list
+    :param elements: набор объектов (строк)
+    :param unique: флаг удаления повторяющихся объектов
+    :param file_w: файл для записи (по умолчанию sys.stdout на момент
+    вызова)
+    :param chunk_size: размер порции
+    """
+    if file_w is None:
+        file_w = sys.stdout
+    chunk = []
+    for pair in iter_pairs(elements, unique):
+        chunk.append('%s\t%s\n' % pair)
+        if len(chunk) >= chunk_size:
+            file_w.write(''.join(chunk))
+            chunk = []
+    file_w.write(''.join(chunk))
 
 
 def main():
     """
     Запуск из командной строки. Берет данные из стандартного ввода (объекты,
     разделенные пробелом) и выводит всевозможные уникальные пары).
-    Принимает ключ --unique: удалять повторяющиеся объекты
+    Принимает ключи:
+    --unique: удалять повторяющиеся объекты;
+    --tsv: выводить пары построчно через табуляцию (а не списком на каждую
+    строку ввода); пары разных строк ввода разделяются пустой строкой
     """
 
     if '--unique' in sys.argv:
         unique = True
     else:
         unique = False
+    tsv = '--tsv' in sys.argv
 
-    for line in sys.stdin:
+    for (line_number, line) in enumerate(sys.stdin):
         elements = line.strip().split(' ')
-        print(pairs(elements, unique))
+        if tsv:
+            if line_number:
+                sys.stdout.write('\n')
+            write_tsv(elements, unique)
+        else:
+            print(pairs(elements, unique))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,266 @@
+#!/usr/bin/env python3.5
+# -*- coding: utf-8 -*-
+
+"""
+Замеры скорости леммера на синтетических данных.
+
+Генерирует запросы и json-вывод Mystem заданного масштаба (количество строк,
+размер словаря, среднее количество лемм в строке, показатель Ципфа),
+замеряет время и пиковую память основных этапов и выводит результат в json,
+чтобы можно было сравнивать прогоны между собой.
+
+Запуск (из папки tests/lem, как и test.py):
+    python3 bench.py --lines 100000 --vocab 20000 --output bench.json
+Для make_gephi_files используется заглушка Mystem fake_mystem.py.
+"""
+
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import sys
+import time
+import tracemalloc
+from bisect import bisect
+from itertools import accumulate
+
+import lem
+import pairs
+
+CYRILLIC = 'абвгдеёжзийклмнопрстуфхцчшщъыьэюя'
+LATIN = 'abcdefghijklmnopqrstuvwxyz'
+GRAMMAR = (
+    'S,муж,неод=(вин,ед|им,ед)',
+    'S,жен,неод=им,ед',
+    'S,сред,неод=(вин,ед|им,ед)',
+    'A=(вин,ед,полн,муж,неод|им,ед,полн,муж)',
+    'V,несов,пе=непрош,ед,изъяв,3-л',
+    'ADV=',
+    'PR=',
+    'CONJ=',
+)
+
+
+def make_vocab(size, rnd, latin_share=0.05):
+    """
+    Словарь псевдослов. Небольшая доля слов - латиницей (non_cyrillic).
+    """
+    vocab = set()
+    while len(vocab) < size:
+        letters = LATIN if rnd.random() < latin_share else CYRILLIC
+        vocab.add(''.join(rnd.choice(letters)
+                          for _ in range(rnd.randint(2, 12))))
+    return sorted(vocab)
+
+
+def generate_queries(lines, vocab_size, lemmas, zipf, seed=0):
+    """
+    Генератор синтетических запросов.
+
+    :param lines: количество строк
+    :param vocab_size: размер словаря
+    :param lemmas: среднее количество слов в строке
+    :param zipf: показатель распределения Ципфа для частоты слов
+    :param seed: начальное значение генератора случайных чисел
+    :return: генератор кортежей (вес, запрос)
+    """
+    rnd = random.Random(seed)
+    vocab = make_vocab(vocab_size, rnd)
+    rnd.shuffle(vocab)
+    cum_weights = list(accumulate(1 / rank ** zipf
+                                  for rank in range(1, vocab_size + 1)))
+    total = cum_weights[-1]
+    for _ in range(lines):
+        count = max(1, int(rnd.expovariate(1 / lemmas) + 0.5))
+        words = [vocab[bisect(cum_weights, rnd.random() * total)]
+                 for _ in range(count)]
+        weight = int(rnd.paretovariate(1.2))
+        yield weight, ' '.join(words)
+
+
+def mystem_json(query, rnd):
+    """
+    json-вывод Mystem для синтетического запроса (как у fake_mystem.py,
+    но с разной грамматикой и долей bastard).
+    """
+    words = []
+    for (i, text) in enumerate(query.split(' ')):
+        if i:
+            words.append({'text': ' '})
+        if text[0] in LATIN:
+            words.append({'analysis': [], 'text': text})
+            continue
+        analysis = {'lex': text, 'gr': rnd.choice(GRAMMAR)}
+        if rnd.random() < 0.05:
+            analysis['qual'] = 'bastard'
+        words.append({'analysis': [analysis], 'text': text})
+    words.append({'text': '\n'})
+    return json.dumps(words, ensure_ascii=False)
+
+
+def generate_files(path_w, lines, vocab_size, lemmas, zipf, seed=0):
+    """
+    Создаёт файлы input.tsv (вес, запрос), lems.json и weights.txt.
+
+    :return: кортеж имён файлов (input.tsv, lems.json, weights.txt)
+    """
+    rnd = random.Random(seed)
+    file_data_name = path_w + 'input.tsv'
+    file_json_name = path_w + 'lems.json'
+    file_weight_name = path_w + 'weights.txt'
+    with open(file_data_name, 'w') as file_data, \
+            open(file_json_name, 'w') as file_json, \
+            open(file_weight_name, 'w') as file_weight:
+        for weight, query in generate_queries(lines, vocab_size, lemmas,
+                                              zipf, seed):
+            print(weight, query, sep='\t', file=file_data)
+            print(mystem_json(query, rnd), file=file_json)
+            print(weight, file=file_weight)
+    return file_data_name, file_json_name, file_weight_name
+
+
+def measure(name, func, items=None, memory=True):
+    """
+    Замеряет время выполнения func и (отдельным прогоном) пиковую память.
+
+    :param name: название этапа
+    :param func: функция без аргументов; может вернуть количество
+    обработанных объектов
+    :param items: количество обработанных объектов (если func его не
+    возвращает)
+    :param memory: замерять ли пиковую память (tracemalloc)
+    :return: словарь с результатом
+    """
+    start = time.perf_counter()
+    result = func()
+    seconds = time.perf_counter() - start
+    if items is None:
+        items = result
+
+    peak = None
+    if memory:
+        tracemalloc.start()
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    report = {'stage': name, 'seconds': round(seconds, 6), 'items': items,
+              'items_per_second': round(items / seconds, 1) if seconds
+              else None,
+              'peak_memory_bytes': peak}
+    print('%-20s %10.3f s %12s items/s' % (name, seconds,
+                                           report['items_per_second']),
+          file=sys.stderr)
+    return report
+
+
+def run(args):
+    path_w = args.workdir.rstrip('/') + '/'
+    if not os.path.exists(path_w):
+        os.makedirs(path_w)
+    (file_data_name, file_json_name, file_weight_name) = generate_files(
+        path_w, args.lines, args.vocab, args.lemmas, args.zipf, args.seed)
+    with open(file_json_name, 'r') as file_json:
+        json_lines = file_json.readlines()
+    with open(file_weight_name, 'r') as file_weight:
+        weights = file_weight.readlines()
+    lines = len(json_lines)
+    memory = not args.no_memory
+    results = []
+
+    results.append(measure(
+        'json_parse', lambda: [lem.json_parse(line) for line in json_lines],
+        lines, memory))
+    parsed = [lem.json_parse(line) for line in json_lines]
+    results.append(measure(
+        'lem_filter', lambda: [lem.lem_filter(line) for line in parsed],
+        lines, memory))
+    del parsed
+    results.append(measure(
+        'line_words', lambda: [lem.line_words(line) for line in json_lines],
+        lines, memory))
+    results.append(measure(
+        'build_node_dict',
+        lambda: lem.build_node_dict(json_lines, weights), lines, memory))
+    results.append(measure(
+        'build_edge_dict',
+        lambda: lem.build_edge_dict(json_lines, weights), lines, memory))
+    results.append(measure(
+        'build_dicts',
+        lambda: lem.build_dicts(json_lines, weights), lines, memory))
+
+    (node_dict, edge_dict) = lem.build_dicts(json_lines, weights)
+    results.append(measure(
+        'write_node_dict',
+        lambda: lem.write_node_dict(io.StringIO(), node_dict),
+        len(node_dict), memory))
+    results.append(measure(
+        'write_edge_dict',
+        lambda: lem.write_edge_dict(io.StringIO(), edge_dict),
+        len(edge_dict), memory))
+    del node_dict, edge_dict
+
+    lems = [[word.lex for word in lem.line_words(line)]
+            for line in json_lines]
+
+    def pairs_stage():
+        return sum(len(pairs.pairs(line_lems, unique=True))
+                   for line_lems in lems)
+    results.append(measure('pairs.pairs', pairs_stage, memory=memory))
+    del lems
+
+    mystem = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'fake_mystem.py')
+    results.append(measure(
+        'make_gephi_files',
+        lambda: lem.make_gephi_files(file_data_name,
+                                     path_r=path_w + 'gephi/',
+                                     path_w=path_w + 'gephi/',
+                                     query_column=2, weight_column=1,
+                                     mystem=mystem),
+        lines, memory))
+
+    return {
+        'config': {'lines': args.lines, 'vocab': args.vocab,
+                   'lemmas': args.lemmas, 'zipf': args.zipf,
+                   'seed': args.seed},
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'results': results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split(
+        '\n')[0])
+    parser.add_argument('--lines', type=int, default=10000,
+                        help='количество строк')
+    parser.add_argument('--vocab', type=int, default=5000,
+                        help='размер словаря')
+    parser.add_argument('--lemmas', type=float, default=3,
+                        help='среднее количество лемм в строке')
+    parser.add_argument('--zipf', type=float, default=1.1,
+                        help='показатель распределения Ципфа')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workdir', default='output/bench/',
+                        help='папка для сгенерированных файлов')
+    parser.add_argument('--output', default=None,
+                        help='файл для json-отчёта (по умолчанию stdout)')
+    parser.add_argument('--no-memory', action='store_true',
+                        help='не замерять пиковую память')
+    args = parser.parse_args()
+
+    report = run(args)
+    if args.output:
+        with open(args.output, 'w') as file_w:
+            json.dump(report, file_w, indent=2, ensure_ascii=False)
+    else:
+        json.dump(report, sys.stdout, indent=2, ensure_ascii=False)
+        print()
+
+
+if __name__ == '__main__':
+    main()
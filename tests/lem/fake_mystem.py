@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Заглушка программы Mystem для тестов. Параметры запуска игнорируются.
+Читает строки со стандартного ввода и на каждую строку выводит одну
+json-строку в формате Mystem (['-cldige', 'utf-8', '--format', 'json']):
+- кириллические слова получают анализ с леммой в нижнем регистре;
+- слова из латинских букв получают анализ нулевой длины;
+- цифры, пробелы и знаки пунктуации выводятся без анализа.
+"""
+
+import json
+import re
+import sys
+
+TOKEN = re.compile(r'\w+|\W')
+CYRILLIC = re.compile(r'^[а-яё]+$', re.IGNORECASE)
+LATIN = re.compile(r'^[a-z]+$', re.IGNORECASE)
+
+
+def analyse(text):
+    if CYRILLIC.match(text):
+        analysis = {'lex': text.lower(), 'gr': 'S,муж,неод=(вин,ед|им,ед)'}
+        if text.endswith('ъ'):
+            analysis['qual'] = 'bastard'
+        return {'analysis': [analysis], 'text': text}
+    if LATIN.match(text):
+        return {'analysis': [], 'text': text}
+    return {'text': text}
+
+
+def main():
+    stdin = open(sys.stdin.fileno(), 'r', encoding='utf-8')
+    stdout = open(sys.stdout.fileno(), 'w', encoding='utf-8')
+    for line in stdin:
+        words = [analyse(text) for text in TOKEN.findall(line.rstrip('\n'))]
+        words.append({'text': '\n'})
+        print(json.dumps(words, ensure_ascii=False), file=stdout)
+        stdout.flush()
+
+
+if __name__ == '__main__':
+    main()